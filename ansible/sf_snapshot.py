@@ -1,10 +1,15 @@
 #!/usr/bin/python
 # A simple Shaken Fist ansible module, with thanks to
 # https://blog.toast38coza.me/custom-ansible-module-hello-world/
-import json
+import shutil
 
 from ansible.module_utils.basic import AnsibleModule
 
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads
+
 
 DOCUMENTATION = """
 ---
@@ -36,85 +41,87 @@ EXAMPLES = """
 """
 
 
+# Resolve sf-client once rather than searching PATH for every command
+SF_CLIENT = shutil.which('sf-client') or 'sf-client'
+
+
 def error(message):
     return True, False, {'error': message}
 
 
-def present(module):
-    if not module.params.get('instance_uuid'):
-        return error('You must specify an instance_uuid when creating an instance')
+def run_sf_client(module, args):
+    # Pass an argument list rather than a string so that no shell is
+    # involved and user supplied values need no quoting. stdout is left as
+    # bytes, the JSON parser does not need it decoded first.
+    rc, stdout, stderr = module.run_command(
+        [SF_CLIENT, '--json'] + args, check_rc=False, encoding=None)
+    if rc != 0:
+        return error('Command failed: %s' % stderr.decode('utf-8', 'replace'))
+
+    # Callers which do not inspect the result can skip parsing it entirely
+    if module.params.get('raw_result'):
+        return False, True, stdout.decode('utf-8', 'replace')
+
+    try:
+        return False, True, json_loads(stdout)
+    except ValueError:
+        return error('Failed to parse JSON: %s' % stdout.decode('utf-8', 'replace'))
 
-    params = {
-        'instance_uuid': module.params.get('instance_uuid')
-    }
 
-    extra = ''
+def present(module):
+    async_strategy = 'block'
+    if module.params.get('async'):
+        async_strategy = 'continue'
+
+    args = ['--async=%s' % async_strategy, 'instance', 'snapshot',
+            module.params['instance_uuid']]
     if module.params.get('all', False):
-        extra += ' --all'
+        args.append('--all')
     if module.params.get('label'):
-        extra += ' --label_name %s' % module.params['label']
+        args.extend(['--label_name', module.params['label']])
     if module.params.get('delete_after_label', False):
-        extra += ' --delete-snapshot-after-label'
-    params['extra'] = extra
+        args.append('--delete-snapshot-after-label')
+    return run_sf_client(module, args)
 
-    params['async_strategy'] = 'block'
-    if module.params.get('async'):
-        params['async_strategy'] = 'continue'
 
-    cmd = ('sf-client --json --async=%(async_strategy)s '
-           'instance snapshot %(instance_uuid)s %(extra)s' % params)
-    rc, stdout, stderr = module.run_command(
-        cmd, check_rc=False, use_unsafe_shell=True)
-    if rc != 0:
-        return True, False, 'Command failed: %s' % stderr
+def absent(module):
+    return run_sf_client(
+        module, ['--async=block', 'artifact', 'delete', module.params['uuid']])
 
-    j = json.loads(stdout)
-    if rc != 0:
-        return True, False, j
-    return False, True, j
 
+FIELDS = {
+    'uuid': {'required': False, 'type': 'str'},
+    'instance_uuid': {'required': False, 'type': 'str'},
+    'all': {'required': False, 'type': 'bool'},
+    'label': {'required': False, 'type': 'str'},
+    'delete_after_label': {'required': False, 'type': 'bool'},
 
-def absent(module):
-    if not module.params.get('uuid'):
-        return error('You must specify a uuid when deleting a snapshot')
+    'async': {'required': False, 'type': 'bool'},
+    'raw_result': {'required': False, 'type': 'bool', 'default': False},
 
-    cmd = ('sf-client --json --async=block artifact delete %(uuid)s'
-           % module.params)
+    'state': {
+        'default': 'present',
+        'choices': ['present', 'absent'],
+        'type': 'str'
+    },
+}
 
-    rc, stdout, stderr = module.run_command(
-        cmd, check_rc=False, use_unsafe_shell=True)
-    if rc != 0:
-        return True, False, 'Command failed: %s' % stderr
+# Parameters which must be set for each state, checked by AnsibleModule
+REQUIRED_IF = [
+    ('state', 'present', ['instance_uuid']),
+    ('state', 'absent', ['uuid']),
+]
 
-    return False, True, None
+CHOICE_MAP = {
+    'present': present,
+    'absent': absent
+}
 
 
 def main():
-
-    fields = {
-        'uuid': {'required': False, 'type': 'str'},
-        'instance_uuid': {'required': False, 'type': 'str'},
-        'all': {'required': False, 'type': 'bool'},
-        'label': {'required': False, 'type': 'str'},
-        'delete_after_label': {'required': False, 'type': 'bool'},
-
-        'async': {'required': False, 'type': 'bool'},
-
-        'state': {
-            'default': 'present',
-            'choices': ['present', 'absent'],
-            'type': 'str'
-        },
-    }
-
-    choice_map = {
-        'present': present,
-        'absent': absent
-    }
-
-    module = AnsibleModule(argument_spec=fields)
-    is_error, has_changed, result = choice_map.get(
-        module.params['state'])(module)
+    module = AnsibleModule(argument_spec=FIELDS, required_if=REQUIRED_IF)
+    # AnsibleModule has already validated state against its choices
+    is_error, has_changed, result = CHOICE_MAP[module.params['state']](module)
 
     if not is_error:
         module.exit_json(changed=has_changed, meta=result)
@@ -1,16 +1,54 @@
-import copy
-import errno
+import base64
+import concurrent.futures
+import functools
+import hashlib
 import json
 import logging
 import os
+import random
+import textwrap
+import threading
 import time
 
 import requests
+import urllib3
 from pbr.version import VersionInfo
 
+try:
+    import orjson
+
+    def _json_dumps(obj):
+        return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS)
+
+    def _json_pretty(obj):
+        return orjson.dumps(
+            obj, option=(orjson.OPT_INDENT_2 | orjson.OPT_SORT_KEYS |
+                         orjson.OPT_NON_STR_KEYS)).decode('utf-8')
+
+    _json_loads = orjson.loads
+
+except ImportError:
+    def _json_dumps(obj):
+        return json.dumps(obj, separators=(',', ':'))
+
+    def _json_pretty(obj):
+        return json.dumps(obj, indent=4, sort_keys=True)
+
+    _json_loads = json.loads
+
+
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
+
+def _pretty(obj):
+    # Pretty print JSON for debug logs, indented under the log line
+    return textwrap.indent(_json_pretty(obj), '    ')
+
 
 LOG = logging.getLogger(__name__)
-LOG.setLevel(logging.INFO)
 
 
 # Async strategies
@@ -18,6 +56,9 @@ ASYNC_CONTINUE = 'continue'
 ASYNC_PAUSE = 'pause'
 ASYNC_BLOCK = 'block'
 
+# Object states which mean creation is still in progress
+PENDING_STATES = frozenset(['initial', 'creating'])
+
 
 class UnconfiguredException(Exception):
     ...
@@ -40,12 +81,14 @@ class TimeoutException(Exception):
 
 
 class APIException(Exception):
-    def __init__(self, message, method, url, status_code, text):
+    def __init__(self, message, method, url, status_code, text,
+                 retry_after=None):
         self.message = message
         self.method = method
         self.url = url
         self.status_code = status_code
         self.text = text
+        self.retry_after = retry_after
 
 
 class RequestMalformedException(APIException):
@@ -80,6 +123,18 @@ class InsufficientResourcesException(APIException):
     ...
 
 
+class RateLimitedException(APIException):
+    ...
+
+
+class ServiceUnavailableException(APIException):
+    ...
+
+
+class GatewayTimeoutException(APIException):
+    ...
+
+
 class UnknownAsyncStrategy(APIException):
     ...
 
@@ -100,9 +155,23 @@ STATUS_CODES_TO_ERRORS = {
     406: DependenciesNotReadyException,
     409: ResourceStateConflictException,
     500: InternalServerError,
+    429: RateLimitedException,
+    503: ServiceUnavailableException,
+    504: GatewayTimeoutException,
     507: InsufficientResourcesException,
 }
 
+# Errors which are likely to go away if we wait. A gateway timeout might
+# still have been acted on by the API server, so we only retry it for
+# methods which are safe to repeat.
+TRANSIENT_ERRORS = (DependenciesNotReadyException, RateLimitedException,
+                    ServiceUnavailableException, GatewayTimeoutException)
+IDEMPOTENT_METHODS = frozenset(['GET', 'HEAD', 'PUT', 'DELETE'])
+
+REDIRECT_STATUS_CODES = frozenset([301, 302, 307, 308])
+ACCEPTABLE_STATUS_CODES = frozenset([200])
+ACCEPTABLE_STATUS_CODES_NO_REDIRECT = frozenset([200, 301])
+
 
 def _calculate_async_deadline(strategy):
     if strategy == ASYNC_CONTINUE:
@@ -114,97 +183,310 @@ def _calculate_async_deadline(strategy):
     raise UnknownAsyncStrategy('Async strategy %s is unknown' % strategy)
 
 
+def _poll_delay(attempt, deadline=None, base=0.1, cap=5.0):
+    # Exponential backoff with full jitter. Fast operations are noticed
+    # quickly, while slow operations (and many clients waiting at once) do
+    # not hammer the API server with a request every second. We never sleep
+    # past the deadline, so the final check happens on time. The exponent is
+    # clamped because some loops poll for an hour without resetting attempt.
+    delay = random.uniform(0, min(cap, base * 2 ** min(attempt, 32)))
+    if deadline is not None:
+        delay = max(0, min(delay, deadline - time.time()))
+    return delay
+
+
+def _parse_retry_after(value):
+    # We only handle the delay-seconds form of Retry-After, not HTTP dates.
+    try:
+        return max(0.0, float(value))
+    except (TypeError, ValueError):
+        return None
+
+
 def _correct_blob_indexes(d):
     # JSON requires dictionary keys to be strings. Reverse that for the blobs
     # element here to reduce confusion.
-    new_blobs = {}
-    for k in d.get('blobs', []):
-        new_blobs[int(k)] = d['blobs'][k]
-    d['blobs'] = new_blobs
-    LOG.debug('Rewrote blob keys to ints')
+    d['blobs'] = {int(k): v for k, v in (d.get('blobs') or {}).items()}
     return d
 
 
+# Blob data is read in large chunks to keep the per chunk Python overhead
+# small relative to the data transferred.
+BLOB_CHUNK_SIZE = 1024 * 1024
+
+# How many requests a client will make concurrently when fanning out
+# independent lookups. This is well inside the connection pool size below.
+EXECUTOR_WORKERS = 8
+
+# Clients constructed with persistent_cache=True, as the command line client
+# is, remember where the API server really lives and reuse bearer tokens
+# between invocations until shortly before they expire.
+ENDPOINT_CACHE = os.path.expanduser('~/.cache/shakenfist/endpoint.json')
+ENDPOINT_CACHE_TTL = 3600
+
+TOKEN_CACHE = os.path.expanduser('~/.cache/shakenfist/token.json')
+TOKEN_CACHE_MARGIN = 60
+
+
+def _is_connect_failure(e):
+    # True only if we failed to connect, so the request was never sent.
+    if isinstance(e, requests.exceptions.ConnectTimeout):
+        return True
+    reason = getattr(e.args[0], 'reason', None) if e.args else None
+    return isinstance(reason, urllib3.exceptions.NewConnectionError)
+
+
+def _read_endpoint_cache():
+    try:
+        with open(ENDPOINT_CACHE, 'rb') as f:
+            return _json_loads(f.read())
+    except (OSError, ValueError):
+        return {}
+
+
+def _lookup_cached_endpoint(configured_url):
+    entry = _read_endpoint_cache().get(configured_url)
+    if not entry or time.time() - entry.get('ts', 0) > ENDPOINT_CACHE_TTL:
+        return None
+    return entry.get('resolved_url')
+
+
+def _update_endpoint_cache(configured_url, resolved_url):
+    # Only redirects are worth remembering, a server which is where it is
+    # configured to be costs nothing extra to find.
+    cache = _read_endpoint_cache()
+    if resolved_url and resolved_url != configured_url:
+        cache[configured_url] = {'resolved_url': resolved_url, 'ts': time.time()}
+    elif configured_url in cache:
+        del cache[configured_url]
+    else:
+        return
+    _write_cache_file(ENDPOINT_CACHE, cache)
+
+
+def _write_cache_file(path, cache):
+    # Cache files are replaced atomically and are only readable by their
+    # owner. They are an optimization, so failing to write one is not an
+    # error.
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = f'{path}.{os.getpid()}'
+        fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'w') as f:
+            f.write(json.dumps(cache, indent=4, sort_keys=True))
+        os.replace(tmp, path)
+    except OSError as e:
+        LOG.debug('Unable to write cache file %s: %s', path, e)
+
+
+def _token_cache_key(base_url, namespace, key):
+    # Tokens are only reused for the same credentials, but the key itself is
+    # never written to disk.
+    return hashlib.sha256(
+        f'{base_url}\0{namespace}\0{key}'.encode('utf-8')).hexdigest()
+
+
+def _token_expiry(auth):
+    # Our bearer tokens are JWTs, so the expiry time is in the payload.
+    try:
+        payload = auth.split(' ')[-1].split('.')[1]
+        payload += '=' * (-len(payload) % 4)
+        return float(_json_loads(base64.urlsafe_b64decode(payload))['exp'])
+    except (IndexError, KeyError, TypeError, ValueError):
+        return None
+
+
+def _read_token_cache():
+    try:
+        with open(TOKEN_CACHE, 'rb') as f:
+            return _json_loads(f.read())
+    except (OSError, ValueError):
+        return {}
+
+
+def _lookup_cached_token(cache_key):
+    entry = _read_token_cache().get(cache_key)
+    if not entry or entry.get('exp', 0) < time.time() + TOKEN_CACHE_MARGIN:
+        return None
+    return entry
+
+
+def _update_token_cache(cache_key, auth, base_url):
+    cache = _read_token_cache()
+    exp = _token_expiry(auth) if auth else None
+    if not exp and cache_key not in cache:
+        return
+
+    now = time.time()
+    cache = {k: v for k, v in cache.items() if v.get('exp', 0) > now}
+    if exp:
+        cache[cache_key] = {'token': auth, 'base_url': base_url, 'exp': exp}
+    else:
+        cache.pop(cache_key, None)
+    _write_cache_file(TOKEN_CACHE, cache)
+
+
+def _iter_json_array(r):
+    # Yield the elements of a JSON array response one at a time. With ijson
+    # the body is parsed as it arrives, otherwise we fall back to parsing the
+    # whole body at once.
+    try:
+        if ijson:
+            r.raw.decode_content = True
+            yield from ijson.items(r.raw, 'item', use_float=True)
+        else:
+            yield from _json_loads(r.content)
+    finally:
+        r.close()
+
+
+@functools.lru_cache(maxsize=None)
+def _read_config_file(path, signature):
+    # The signature is only part of the cache key, so that an edited file is
+    # read again.
+    with open(path, 'rb') as f:
+        return _json_loads(f.read())
+
+
+def _load_config_file(path):
+    # Configuration files are parsed once per process for as long as they
+    # are unchanged, not once per client constructed. Missing and unreadable
+    # files are both simply skipped.
+    try:
+        st = os.stat(path)
+        return _read_config_file(path, (st.st_mtime_ns, st.st_size))
+    except (FileNotFoundError, PermissionError):
+        return None
+
+
+def _make_session():
+    # A single session per client keeps connections to the API server alive
+    # between requests. The pool is sized so that concurrent callers sharing
+    # a client do not have to open throwaway connections.
+    session = requests.Session()
+    session.headers['User-Agent'] = get_user_agent()
+    adapter = requests.adapters.HTTPAdapter(
+        pool_connections=10, pool_maxsize=20, max_retries=0)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
 class Client:
     def __init__(self, base_url=None, verbose=False,
                  namespace=None, key=None, sync_request_timeout=300,
                  suppress_configuration_lookup=False, logger=None,
-                 async_strategy=ASYNC_BLOCK):
-        global LOG
+                 async_strategy=ASYNC_BLOCK, session=None,
+                 persistent_cache=False):
+        # Each client logs to its own logger if given one, so that several
+        # clients in one process do not reconfigure each other's logging.
+        self.log = logger or LOG
         if verbose:
-            LOG.setLevel(logging.DEBUG)
-        if logger:
-            LOG = logger
+            self.log.setLevel(logging.DEBUG)
 
         self.most_recent_request_id = None
         self.sync_request_timeout = sync_request_timeout
 
-        LOG.debug('Client initially configured with apiurl of %s for namespace %s '
-                  'and async strategy %s'
-                  % (base_url, namespace, async_strategy))
+        self.log.debug('Client initially configured with apiurl of %s for namespace %s '
+                       'and async strategy %s',
+                       base_url, namespace, async_strategy)
 
         if not suppress_configuration_lookup:
             # Where do we find authentication details? First off, we try command line
             # flags; then environment variables (thanks for doing this for free click);
             # ~/.shakenfist (which is a JSON file); and finally /etc/sf/shakenfist.json.
-            if not base_url:
-                LOG.debug('Testing for ~/.shakenfist')
-                user_conf = os.path.expanduser('~/.shakenfist')
-                if os.path.exists(user_conf):
-                    LOG.debug('Loading configuration from ~/.shakenfist')
-                    with open(user_conf) as f:
-                        d = json.loads(f.read())
-                        if not namespace:
-                            namespace = d['namespace']
-                        if not key:
-                            key = d['key']
-                        if not base_url:
-                            base_url = d['apiurl']
-
-            if not base_url:
-                LOG.debug('Testing for /etc/sf/shakenfist.json')
-                try:
-                    if os.path.exists('/etc/sf/shakenfist.json'):
-                        LOG.debug(
-                            'Loading configuration from /etc/sf/shakenfist.json')
-                        with open('/etc/sf/shakenfist.json') as f:
-                            d = json.loads(f.read())
-                            if not namespace:
-                                namespace = d['namespace']
-                            if not key:
-                                key = d['key']
-                            if not base_url:
-                                base_url = d['apiurl']
-                except OSError as e:
-                    if e.errno != errno.EACCES:
-                        raise
+            for config_path in [os.path.expanduser('~/.shakenfist'),
+                                '/etc/sf/shakenfist.json']:
+                if base_url:
+                    break
+
+                self.log.debug('Testing for %s', config_path)
+                d = _load_config_file(config_path)
+                if d:
+                    self.log.debug('Loading configuration from %s', config_path)
+                    if not namespace:
+                        namespace = d['namespace']
+                    if not key:
+                        key = d['key']
+                    base_url = d['apiurl']
 
         if not base_url:
             raise UnconfiguredException(
                 'You have not specified the server to communicate with')
 
         self.base_url = base_url
+        self.configured_base_url = base_url
         self.namespace = namespace
         self.key = key
         self.async_strategy = async_strategy
-        LOG.debug('Client configured with apiurl of %s for namespace %s '
-                  'and async strategy %s'
-                  % (self.base_url, self.namespace, self.async_strategy))
+        self.log.debug('Client configured with apiurl of %s for namespace %s '
+                       'and async strategy %s',
+                       self.base_url, self.namespace, self.async_strategy)
 
         self.cached_auth = None
-
-        self.session = requests.Session()
-
-        # Request capabilities information
-        self._collect_capabilities()
+        self.persistent_cache = persistent_cache
+        self._token_key = _token_cache_key(
+            self.configured_base_url, self.namespace, self.key)
+
+        # Callers may hand us an existing session so that several clients
+        # share one pool of keep-alive connections to the API server.
+        self.session = session or _make_session()
+        self._owns_session = session is None
+        self._executor = None
+
+        # Clients may be shared between threads, for example by the executor
+        # below. This lock serializes replacing the session, authenticating
+        # and changing base_url, so that concurrent failures only repair
+        # things once.
+        self._lock = threading.RLock()
+
+        # Capabilities information is requested the first time it is needed,
+        # many commands never ask.
+        self.root_html = None
+        self._capabilities = {}
+
+    @property
+    def executor(self):
+        # A thread pool for callers which need to make many independent
+        # requests, for example a lookup per instance. It is only created
+        # when first used.
+        if not self._executor:
+            self._executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=EXECUTOR_WORKERS)
+        return self._executor
+
+    def close(self):
+        if self._executor:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+        # A session handed to us belongs to the caller, who may still be
+        # using it
+        if self._owns_session:
+            self.session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
 
     def _collect_capabilities(self):
         r = self.session.request('GET', self.base_url, allow_redirects=True)
         self.root_html = r.text
+        self._capabilities = {}
 
     def check_capability(self, capability_string):
         # NOTE(mikal): this likely needs to be fancier
-        return capability_string in self.root_html
+        # We remember answers so that repeated checks do not each search the
+        # whole page.
+        if self.root_html is None:
+            self._collect_capabilities()
+        try:
+            return self._capabilities[capability_string]
+        except KeyError:
+            present = capability_string in self.root_html
+            self._capabilities[capability_string] = present
+            return present
 
     def _actual_request_url(self, method, url, data=None,
                             request_body_is_binary=False,
@@ -212,110 +494,159 @@ class Client:
                             allow_redirects=True, stream=False):
         url = self.base_url + url
 
-        h = {
-                'Authorization': self.cached_auth,
-                'User-Agent': get_user_agent()
-            }
+        h = self._auth_headers
         if data:
             if request_body_is_binary:
-                h['Content-Type'] = 'application/octet-stream'
+                h = self._binary_headers
             else:
-                h['Content-Type'] = 'application/json'
-                data = json.dumps(data, indent=4, sort_keys=True)
+                h = self._json_headers
+                data = _json_dumps(data)
 
         start_time = time.time()
+        session = self.session
         try:
-            r = self.session.request(method, url, data=data, headers=h,
-                                     allow_redirects=allow_redirects,
-                                     stream=stream)
+            r = session.request(method, url, data=data, headers=h,
+                                allow_redirects=allow_redirects,
+                                stream=stream)
 
         except requests.exceptions.ConnectionError:
-            # Session was terminated gracelessly, rebuild it
-            self.session = requests.Session()
-            r = self.session.request(method, url, data=data, headers=h,
-                                     allow_redirects=allow_redirects,
-                                     stream=stream)
+            # Session was terminated gracelessly, rebuild it unless another
+            # thread already has
+            with self._lock:
+                if self.session is session:
+                    self.session = _make_session()
+                    self._owns_session = True
+                session = self.session
+            r = session.request(method, url, data=data, headers=h,
+                                allow_redirects=allow_redirects,
+                                stream=stream)
 
         end_time = time.time()
+        self.most_recent_request_id = r.headers.get('X-Request-ID')
+
+        # All of this is expensive (it decodes and re-encodes the response
+        # body), so only do it if someone is going to see it.
+        if self.log.isEnabledFor(logging.DEBUG):
+            self._log_request(method, url, h, data, request_body_is_binary, r,
+                              response_body_is_binary, stream,
+                              end_time - start_time)
+
+        exception_class = STATUS_CODES_TO_ERRORS.get(r.status_code)
+        if exception_class:
+            raise exception_class(
+                'API request failed', method, url, r.status_code, r.text,
+                retry_after=_parse_retry_after(r.headers.get('Retry-After')))
+
+        if allow_redirects:
+            acceptable = ACCEPTABLE_STATUS_CODES
+        else:
+            acceptable = ACCEPTABLE_STATUS_CODES_NO_REDIRECT
+        if r.status_code not in acceptable:
+            raise APIException(
+                'API request failed', method, url, r.status_code, r.text)
+        return r
 
-        LOG.debug('-------------------------------------------------------')
-        LOG.debug(f'API client requested: {method} {url}')
+    # The header dictionaries are built once per authentication rather than
+    # once per request. They are not set on the session itself because
+    # callers may share a session between clients with different credentials.
+    # Treat them as read only.
+    @property
+    def cached_auth(self):
+        return self._cached_auth
+
+    @cached_auth.setter
+    def cached_auth(self, value):
+        self._cached_auth = value
+        self._auth_headers = {'Authorization': value,
+                              'User-Agent': get_user_agent()}
+        self._json_headers = dict(self._auth_headers)
+        self._json_headers['Content-Type'] = 'application/json'
+        self._binary_headers = dict(self._auth_headers)
+        self._binary_headers['Content-Type'] = 'application/octet-stream'
+
+    def _log_request(self, method, url, h, data, request_body_is_binary, r,
+                     response_body_is_binary, stream, duration):
+        self.log.debug('-------------------------------------------------------')
+        self.log.debug('API client requested: %s %s', method, url)
         for hkey in h:
             if hkey == 'Authorization' and h[hkey]:
-                LOG.debug('Header: Authorization = Bearer *****')
+                self.log.debug('Header: Authorization = Bearer *****')
             else:
-                LOG.debug(f'Header: {hkey} = {h[hkey]}')
+                self.log.debug('Header: %s = %s', hkey, h[hkey])
         if data:
             if request_body_is_binary:
-                LOG.debug('Data: ...%d bytes of binary omitted...' % len(data))
+                self.log.debug('Data: ...%d bytes of binary omitted...', len(data))
             else:
-                LOG.debug('Data:\n    %s' % '\n    '.join(data.split('\n')))
-        for h in r.history:
-            LOG.debug('URL request history: %s --> %s %s'
-                      % (h.url, h.status_code, h.headers.get('Location')))
-        LOG.debug('API client response: code = %s (took %.02f seconds)'
-                  % (r.status_code, (end_time - start_time)))
+                # Request bodies are sent compact, reformat them for humans
+                self.log.debug('Data:\n%s', _pretty(_json_loads(data)))
+        for hist in r.history:
+            self.log.debug('URL request history: %s --> %s %s',
+                           hist.url, hist.status_code, hist.headers.get('Location'))
+        self.log.debug('API client response: code = %s, content encoding = %s '
+                       '(took %.02f seconds)',
+                       r.status_code, r.headers.get('Content-Encoding', 'none'),
+                       duration)
 
-        self.most_recent_request_id = r.headers.get('X-Request-ID')
         for hkey in r.headers:
-            LOG.debug(f'Header: {hkey} = {r.headers[hkey]}')
+            self.log.debug('Header: %s = %s', hkey, r.headers[hkey])
 
-        if not stream and r.text:
+        if not stream and r.content:
             if response_body_is_binary:
-                LOG.debug('Data: ...%d bytes of binary omitted...'
-                          % len(r.text))
+                self.log.debug('Data: ...%d bytes of binary omitted...',
+                               len(r.content))
             else:
                 try:
-                    LOG.debug('Data:\n    %s'
-                              % ('\n    '.join(json.dumps(json.loads(r.text),
-                                                          indent=4,
-                                                          sort_keys=True).split('\n'))))
+                    self.log.debug('Data:\n%s', _pretty(_json_loads(r.content)))
                 except Exception:
-                    LOG.debug('Text:\n    %s'
-                              % ('\n    '.join(r.text.split('\n'))))
-        LOG.debug('-------------------------------------------------------')
-
-        if r.status_code in STATUS_CODES_TO_ERRORS:
-            raise STATUS_CODES_TO_ERRORS[r.status_code](
-                'API request failed', method, url, r.status_code, r.text)
-
-        acceptable = [200]
-        if not allow_redirects:
-            acceptable.append(301)
-        if r.status_code not in acceptable:
-            raise APIException(
-                'API request failed', method, url, r.status_code, r.text)
-        return r
+                    self.log.debug('Text:\n%s', textwrap.indent(r.text, '    '))
+        self.log.debug('-------------------------------------------------------')
 
     def _authenticate(self):
-        LOG.debug('Authentication request made, contents not logged')
-        auth_url = self.base_url + '/auth'
-        r = requests.request('POST', auth_url,
-                             data=json.dumps(
-                                 {'namespace': self.namespace,
-                                  'key': self.key}),
-                             headers={'Content-Type': 'application/json',
-                                      'User-Agent': get_user_agent()})
+        self.log.debug('Authentication request made, contents not logged')
+        auth_url = f'{self.base_url}/auth'
+        r = self._post_authentication(auth_url)
+        if r.status_code in REDIRECT_STATUS_CODES:
+            # Rather than probing the base_url for redirections before
+            # authenticating, we notice them here. If we are redirected,
+            # rewrite our base_url to the redirection target and try again.
+            location = r.headers['Location']
+            self.log.debug('API server redirects to %s', location)
+            if location.endswith('/auth'):
+                self.base_url = location[:-len('/auth')]
+            else:
+                self._probe_endpoint()
+            auth_url = f'{self.base_url}/auth'
+            r = self._post_authentication(auth_url)
+
         if r.status_code != 200:
             raise UnauthenticatedException('API unauthenticated', 'POST', auth_url,
                                            r.status_code, r.text)
-        return 'Bearer %s' % r.json()['access_token']
+        auth = 'Bearer %s' % _json_loads(r.content)['access_token']
+        if self.persistent_cache:
+            _update_token_cache(self._token_key, auth, self.base_url)
+        return auth
+
+    def _post_authentication(self, auth_url):
+        # Redirects are not followed, as requests would turn the POST into a
+        # GET and drop our credentials.
+        return self.session.request(
+            'POST', auth_url,
+            data=_json_dumps({'namespace': self.namespace, 'key': self.key}),
+            headers={'Content-Type': 'application/json',
+                     'User-Agent': get_user_agent()},
+            allow_redirects=False)
 
     def _request_url(self, method, url, data=None, request_body_is_binary=False,
                      response_body_is_binary=False, stream=False):
-        # NOTE(mikal): if we are not authenticated, probe the base_url looking
-        # for redirections. If we are redirected, rewrite our base_url to the
-        # redirection target.
+        endpoint_from_cache = False
         if not self.cached_auth:
-            probe = self._actual_request_url('GET', '', allow_redirects=False)
-            if probe.status_code == 301:
-                LOG.debug('API server redirects to %s'
-                          % probe.headers['Location'])
-                self.base_url = probe.headers['Location']
-            self.cached_auth = self._authenticate()
+            endpoint_from_cache = self._initial_authentication()
 
         deadline = time.time() + _calculate_async_deadline(self.async_strategy)
+        attempt = 0
         while True:
+            used_auth = self.cached_auth
+            used_url = self.base_url
             try:
                 try:
                     return self._actual_request_url(
@@ -324,29 +655,119 @@ class Client:
                         response_body_is_binary=response_body_is_binary,
                         stream=stream)
                 except UnauthenticatedException:
-                    self.cached_auth = self._authenticate()
+                    self._refresh_authentication(used_auth)
                     return self._actual_request_url(
                         method, url, data=data,
                         request_body_is_binary=request_body_is_binary,
                         response_body_is_binary=response_body_is_binary,
                         stream=stream)
 
-            except DependenciesNotReadyException as e:
+            except requests.exceptions.ConnectionError as e:
+                # A cached endpoint we can no longer connect to is stale, so
+                # forget it. Only resend idempotent requests to the configured
+                # location, anything else is left for the caller to retry.
+                if not endpoint_from_cache or not _is_connect_failure(e):
+                    raise
+                self._forget_endpoint(used_url)
+                endpoint_from_cache = False
+                if method not in IDEMPOTENT_METHODS:
+                    raise
+
+            except TRANSIENT_ERRORS as e:
                 # The API server will return a 406 exception when we have
                 # specified an operation which depends on a resource and
-                # that resource is not in the created state.
-                if time.time() > deadline:
-                    LOG.debug('Deadline exceeded waiting for dependancies')
+                # that resource is not in the created state. Rate limiting
+                # and an overloaded server are handled the same way.
+                if (isinstance(e, GatewayTimeoutException) and
+                        method not in IDEMPOTENT_METHODS):
+                    raise e
+                remaining = deadline - time.time()
+                if remaining < 0:
+                    self.log.debug('Deadline exceeded retrying request')
                     raise e
 
-                LOG.debug('Dependencies not ready, retrying')
-                time.sleep(1)
+                self.log.debug('API server returned %d, retrying', e.status_code)
+                if e.retry_after is not None:
+                    time.sleep(min(e.retry_after, remaining))
+                else:
+                    time.sleep(_poll_delay(attempt, deadline))
+                attempt += 1
+
+    def _request_json(self, *args, **kwargs):
+        # Most API calls just want the decoded response body. Decode the raw
+        # bytes with our decoder rather than going via requests' r.json().
+        return _json_loads(self._request_url(*args, **kwargs).content)
+
+    def _initial_authentication(self):
+        # If we are not authenticated, do that first. If asked to, where the
+        # API server really lives and a still valid token are cached between
+        # invocations, which saves short lived command line clients from
+        # following a redirect and authenticating each time. Returns True if
+        # base_url came from one of those caches.
+        with self._lock:
+            if self.cached_auth:
+                return False
+
+            endpoint_from_cache = False
+            if self.persistent_cache:
+                entry = _lookup_cached_token(self._token_key)
+                if entry:
+                    self.log.debug('Using cached token for %s', entry['base_url'])
+                    self.base_url = entry['base_url']
+                    self.cached_auth = entry['token']
+                    return True
+
+                resolved_url = _lookup_cached_endpoint(self.configured_base_url)
+                if resolved_url:
+                    self.log.debug('Using cached API server location %s', resolved_url)
+                    self.base_url = resolved_url
+                    endpoint_from_cache = True
+
+            try:
+                self.cached_auth = self._authenticate()
+            except requests.exceptions.ConnectionError as e:
+                if not endpoint_from_cache or not _is_connect_failure(e):
+                    raise
+                self._forget_endpoint(self.base_url)
+                endpoint_from_cache = False
+
+            if self.persistent_cache and not endpoint_from_cache:
+                _update_endpoint_cache(self.configured_base_url, self.base_url)
+            return endpoint_from_cache
+
+    def _refresh_authentication(self, rejected_auth):
+        # Concurrent requests may all be rejected for the same expired token,
+        # only the first of them authenticates again.
+        with self._lock:
+            if self.cached_auth == rejected_auth:
+                self.cached_auth = self._authenticate()
+
+    def _probe_endpoint(self):
+        # Used when an authentication redirect does not point at an auth
+        # endpoint, so we cannot derive the new base_url from it.
+        probe = self._actual_request_url('GET', '', allow_redirects=False)
+        if probe.status_code == 301:
+            self.log.debug('API server redirects to %s',
+                           probe.headers['Location'])
+            self.base_url = probe.headers['Location']
+
+    def _forget_endpoint(self, failed_url):
+        with self._lock:
+            if self.base_url != failed_url:
+                # Another thread has already moved on from this location
+                return
+
+            self.log.debug('Cached API server location %s failed, trying %s',
+                           failed_url, self.configured_base_url)
+            _update_endpoint_cache(self.configured_base_url, None)
+            self.base_url = self.configured_base_url
+            self.cached_auth = self._authenticate()
+            _update_endpoint_cache(self.configured_base_url, self.base_url)
 
     # The metadata calls are repetitive and handled here as a group
     def _get_metadata(self, object_plural, object_reference):
-        r = self._request_url(
-            'GET', '/' + object_plural + '/' + object_reference + '/metadata')
-        return r.json()
+        return self._request_json(
+            'GET', f'/{object_plural}/{object_reference}/metadata')
 
     def get_artifact_metadata(self, artifact_ref):
         return self._get_metadata('artifacts', artifact_ref)
@@ -370,10 +791,9 @@ class Client:
         return self._get_metadata('nodes', node)
 
     def _set_metadata(self, object_plural, object_reference, key, value):
-        r = self._request_url(
-            'PUT', '/' + object_plural + '/' + object_reference +
-            '/metadata/' + key, data={'value': value})
-        return r.json()
+        return self._request_json(
+            'PUT', f'/{object_plural}/{object_reference}/metadata/{key}',
+            data={'value': value})
 
     def set_artifact_metadata_item(self, artifact_ref, key, value):
         return self._set_metadata('artifacts', artifact_ref, key, value)
@@ -397,10 +817,8 @@ class Client:
         return self._set_metadata('nodes', node, key, value)
 
     def _delete_metadata(self, object_plural, object_reference, key):
-        r = self._request_url(
-            'DELETE', '/' + object_plural + '/' + object_reference +
-            '/metadata/' + key)
-        return r.json()
+        return self._request_json(
+            'DELETE', f'/{object_plural}/{object_reference}/metadata/{key}')
 
     def delete_artifact_metadata_item(self, artifact_ref, key):
         return self._delete_metadata('artifacts', artifact_ref, key)
@@ -437,10 +855,9 @@ class Client:
         if limit:
             body['limit'] = limit
 
-        r = self._request_url(
-            'GET', '/' + object_plural + '/' + object_reference + '/events',
+        return self._request_json(
+            'GET', f'/{object_plural}/{object_reference}/events',
             body)
-        return r.json()
 
     def get_artifact_events(self, artifact_ref, event_type=None, limit=None):
         return self._get_events('artifacts', artifact_ref, event_type, limit)
@@ -456,30 +873,38 @@ class Client:
 
     # Other calls
     def get_instances(self, all=False):
-        r = self._request_url('GET', '/instances', data={'all': all})
-        return r.json()
+        return self._request_json('GET', '/instances', data={'all': all})
+
+    def iter_instances(self, all=False):
+        r = self._request_url('GET', '/instances', data={'all': all},
+                              stream=True)
+        return _iter_json_array(r)
 
     def delete_all_instances(self, namespace):
-        r = self._request_url('DELETE', '/instances',
-                              data={'confirm': True,
-                                    'namespace': namespace})
-        deleted = r.json()
+        deleted = self._request_json('DELETE', '/instances',
+                                     data={'confirm': True,
+                                           'namespace': namespace})
         waiting_for = set(deleted)
 
         deadline = time.time() + _calculate_async_deadline(self.async_strategy)
+        attempt = 0
         while waiting_for:
-            LOG.debug('Waiting for instances to deleted: %s'
-                      % ', '.join(waiting_for))
+            self.log.debug('Waiting for instances to be deleted: %s', waiting_for)
             if time.time() > deadline:
-                LOG.debug('Deadline exceeded waiting for instances to delete')
+                self.log.debug('Deadline exceeded waiting for instances to delete')
                 break
 
-            time.sleep(1)
-            for uuid in copy.copy(waiting_for):
-                inst = self.get_instance(uuid)
-                if not inst or inst['state'] == 'deleted':
-                    LOG.debug('Instance %s is now deleted' % uuid)
-                    waiting_for.remove(uuid)
+            time.sleep(_poll_delay(attempt, deadline))
+            attempt += 1
+            # One listing per poll rather than one GET per instance. Instances
+            # which are no longer listed at all are also considered deleted.
+            states = {i['uuid']: i['state'] for i in self.get_instances(all=True)}
+            done = {uuid for uuid in waiting_for
+                    if states.get(uuid) in (None, 'deleted')}
+            if done:
+                self.log.debug('Instances %s are now deleted', done)
+                waiting_for -= done
+                attempt = 0
 
         return deleted
 
@@ -492,13 +917,10 @@ class Client:
         data = None
         if namespace:
             data = {'namespace': namespace}
-        r = self._request_url('GET', '/instances/' + instance_ref, data=data)
-        return r.json()
+        return self._request_json('GET', f'/instances/{instance_ref}', data=data)
 
     def get_instance_interfaces(self, instance_ref):
-        r = self._request_url('GET', '/instances/' + instance_ref +
-                              '/interfaces')
-        return r.json()
+        return self._request_json('GET', f'/instances/{instance_ref}/interfaces')
 
     def create_instance(self, name, cpus, memory, network, disk, sshkey, userdata,
                         namespace=None, force_placement=None, video=None, uefi=False,
@@ -536,32 +958,32 @@ class Client:
             clean_disks.append(d)
         body['disk'] = clean_disks
 
-        r = self._request_url('POST', '/instances', data=body)
-        i = r.json()
+        i = self._request_json('POST', '/instances', data=body)
+        if self.async_strategy == ASYNC_CONTINUE:
+            return i
 
         deadline = time.time() + _calculate_async_deadline(self.async_strategy)
+        attempt = 0
         while True:
-            if i['state'] not in ['initial', 'creating']:
+            if i['state'] not in PENDING_STATES:
                 return i
 
-            LOG.debug('Waiting for instance to be created')
+            self.log.debug('Waiting for instance to be created')
             if time.time() > deadline:
-                LOG.debug('Deadline exceeded waiting for instance to be created')
+                self.log.debug('Deadline exceeded waiting for instance to be created')
                 return i
 
-            time.sleep(1)
+            time.sleep(_poll_delay(attempt, deadline))
+            attempt += 1
             i = self.get_instance(i['uuid'])
 
     def snapshot_instance(self, instance_ref, all=False, device=None, label_name=None,
                           delete_snapshot_after_label=False, thin=False):
-        r = self._request_url(
-            'POST', '/instances/' + instance_ref + '/snapshot',
+        out = self._request_json(
+            'POST', f'/instances/{instance_ref}/snapshot',
             data={'all': all, 'device': device, 'thin': thin})
-        out = r.json()
 
-        waiting_for = []
-        for s in out:
-            waiting_for.append(out[s]['blob_uuid'])
+        waiting_for = {out[s]['blob_uuid'] for s in out}
 
         # If we are going to apply a label, then we must block for the snapshot
         # to complete before we can apply the label.
@@ -570,21 +992,23 @@ class Client:
             async_strategy = ASYNC_BLOCK
 
         deadline = time.time() + _calculate_async_deadline(async_strategy)
+        attempt = 0
         while waiting_for:
-            LOG.debug('Waiting for snapshots: %s' % ', '.join(waiting_for))
+            self.log.debug('Waiting for snapshots: %s', waiting_for)
             if time.time() > deadline:
-                LOG.debug('Deadline exceeded waiting for snapshots')
+                self.log.debug('Deadline exceeded waiting for snapshots')
                 break
 
-            time.sleep(1)
-            snaps = self.get_instance_snapshots(instance_ref)
-            for s in snaps:
-                if s.get('blob_uuid') in waiting_for:
-                    if s.get('state') == 'created':
-                        LOG.debug('Blob %s now present' % s['blob_uuid'])
-                        waiting_for.remove(s['blob_uuid'])
-                    else:
-                        LOG.debug('Blob %s not yet created' % s['blob_uuid'])
+            time.sleep(_poll_delay(attempt, deadline))
+            attempt += 1
+            created = {s.get('blob_uuid')
+                       for s in self.get_instance_snapshots(instance_ref)
+                       if s.get('state') == 'created'}
+            done = waiting_for & created
+            if done:
+                self.log.debug('Blobs %s now present', done)
+                waiting_for -= done
+                attempt = 0
 
         if not all and label_name:
             # It only makes sense to update a label if we've snapshotted a single
@@ -601,9 +1025,7 @@ class Client:
         return out
 
     def get_instance_snapshots(self, instance_ref):
-        r = self._request_url('GET', '/instances/' + instance_ref +
-                              '/snapshot')
-        return r.json()
+        return self._request_json('GET', f'/instances/{instance_ref}/snapshot')
 
     def get_instance_agentoperations(self, instance_ref, all=False):
         if not self.check_capability('instance-agentoperations'):
@@ -615,42 +1037,30 @@ class Client:
                 'The API server version you are talking to does not support '
                 'looking up all agent operations for an instance.')
 
-        r = self._request_url('GET', '/instances/' + instance_ref +
-                              '/agentoperations', data={'all': all})
-        return r.json()
+        return self._request_json('GET', f'/instances/{instance_ref}/agentoperations',
+                                  data={'all': all})
 
     def update_label(self, label_name, blob_uuid):
-        r = self._request_url(
-            'POST', '/label/%s' % label_name, data={'blob_uuid': blob_uuid})
-        return _correct_blob_indexes(r.json())
+        return _correct_blob_indexes(self._request_json(
+            'POST', '/label/%s' % label_name, data={'blob_uuid': blob_uuid}))
 
     def reboot_instance(self, instance_ref, hard=False):
         style = 'soft'
         if hard:
             style = 'hard'
-        r = self._request_url('POST', '/instances/' + instance_ref +
-                              '/reboot' + style)
-        return r.json()
+        return self._request_json('POST', f'/instances/{instance_ref}/reboot{style}')
 
     def power_off_instance(self, instance_ref):
-        r = self._request_url('POST', '/instances/' + instance_ref +
-                              '/poweroff')
-        return r.json()
+        return self._request_json('POST', f'/instances/{instance_ref}/poweroff')
 
     def power_on_instance(self, instance_ref):
-        r = self._request_url('POST', '/instances/' + instance_ref +
-                              '/poweron')
-        return r.json()
+        return self._request_json('POST', f'/instances/{instance_ref}/poweron')
 
     def pause_instance(self, instance_ref):
-        r = self._request_url('POST', '/instances/' + instance_ref +
-                              '/pause')
-        return r.json()
+        return self._request_json('POST', f'/instances/{instance_ref}/pause')
 
     def unpause_instance(self, instance_ref):
-        r = self._request_url('POST', '/instances/' + instance_ref +
-                              '/unpause')
-        return r.json()
+        return self._request_json('POST', f'/instances/{instance_ref}/unpause')
 
     def add_instance_interface(self, instance_ref, netdesc):
         if not self.check_capability('hot-plug-interface'):
@@ -658,9 +1068,8 @@ class Client:
                 'The API server version you are talking to does not support '
                 'hot plugging an interface into an instance.')
 
-        r = self._request_url('POST', '/instances/' + instance_ref +
-                              '/interfaces', data={'network': netdesc})
-        return r.json()
+        return self._request_json('POST', f'/instances/{instance_ref}/interfaces',
+                                  data={'network': netdesc})
 
     def delete_instance(self, instance_ref, namespace=None, async_request=False):
         # Why pass a namespace when you're passing an exact UUID? The idea here
@@ -669,38 +1078,41 @@ class Client:
         data = None
         if namespace:
             data = {'namespace': namespace}
-        r = self._request_url('DELETE', '/instances/' +
-                              instance_ref, data=data)
 
         if async_request:
+            self._request_url('DELETE', f'/instances/{instance_ref}', data=data)
             return {}
 
-        obj_uuid = r.json().get('uuid')
+        i = self._request_json('DELETE', f'/instances/{instance_ref}', data=data)
+        obj_uuid = i.get('uuid')
         if not obj_uuid:
             print('ERROR: No instance UUID returned by API')
             return {}
+        if self.async_strategy == ASYNC_CONTINUE:
+            return i
 
         deadline = time.time() + _calculate_async_deadline(self.async_strategy)
+        attempt = 0
         while True:
             i = self.get_instance(obj_uuid)
             if i['state'] == 'deleted':
                 return i
 
-            LOG.debug('Waiting for instance to be deleted')
+            self.log.debug('Waiting for instance to be deleted')
             if time.time() > deadline:
-                LOG.debug('Deadline exceeded waiting for instance to delete')
+                self.log.debug('Deadline exceeded waiting for instance to delete')
                 return i
 
-            time.sleep(1)
+            time.sleep(_poll_delay(attempt, deadline))
+            attempt += 1
 
     def cache_artifact(self, image_url, shared=False, namespace=None):
-        r = self._request_url('POST', '/artifacts',
-                              data={
-                                  'url': image_url,
-                                  'shared': shared,
-                                  'namespace': namespace
-                              })
-        return r.json()
+        return self._request_json('POST', '/artifacts',
+                                  data={
+                                      'url': image_url,
+                                      'shared': shared,
+                                      'namespace': namespace
+                                  })
 
     def upload_artifact(self, name, upload_uuid, source_url=None, shared=False,
                         namespace=None, artifact_type='image'):
@@ -713,87 +1125,77 @@ class Client:
                     'The API server version you are talking to does not support '
                     'specifying upload artifact types other than image.')
 
-        r = self._request_url('POST', '/artifacts/upload/%s' % name,
-                              data={
-                                  'upload_uuid': upload_uuid,
-                                  'source_url': source_url,
-                                  'shared': shared,
-                                  'namespace': namespace
-                              })
-        return r.json()
+        return self._request_json('POST', '/artifacts/upload/%s' % name,
+                                  data={
+                                      'upload_uuid': upload_uuid,
+                                      'source_url': source_url,
+                                      'shared': shared,
+                                      'namespace': namespace
+                                  })
 
     def blob_artifact(self, name, blob_uuid, source_url=None, shared=False,
                       namespace=None):
         if '/' in name:
             raise InvalidException('Names must not contain /')
 
-        r = self._request_url('POST', '/artifacts/upload/%s' % name,
-                              data={
-                                  'blob_uuid': blob_uuid,
-                                  'source_url': source_url,
-                                  'shared': shared,
-                                  'namespace': namespace
-                              })
-        return r.json()
+        return self._request_json('POST', '/artifacts/upload/%s' % name,
+                                  data={
+                                      'blob_uuid': blob_uuid,
+                                      'source_url': source_url,
+                                      'shared': shared,
+                                      'namespace': namespace
+                                  })
 
     def get_artifact(self, artifact_ref):
-        r = self._request_url('GET', '/artifacts/' + artifact_ref)
-        return _correct_blob_indexes(r.json())
+        return _correct_blob_indexes(
+            self._request_json('GET', f'/artifacts/{artifact_ref}'))
 
     def get_artifacts(self, node=None):
-        r = self._request_url('GET', '/artifacts', data={'node': node})
+        return [_correct_blob_indexes(a) for a in
+                self._request_json('GET', '/artifacts', data={'node': node})]
 
-        out = []
-        for a in r.json():
-            out.append(_correct_blob_indexes(a))
-        return out
+    def iter_artifacts(self, node=None):
+        r = self._request_url('GET', '/artifacts', data={'node': node},
+                              stream=True)
+        return (_correct_blob_indexes(a) for a in _iter_json_array(r))
 
     def get_artifact_versions(self, artifact_ref):
-        r = self._request_url(
-            'GET', '/artifacts/' + artifact_ref + '/versions')
-        return r.json()
+        return self._request_json(
+            'GET', f'/artifacts/{artifact_ref}/versions')
 
     def set_artifact_max_versions(self, artifact_ref, max_versions):
-        r = self._request_url('POST',
-                              '/artifacts/' + artifact_ref + '/versions',
-                              data={'max_versions': max_versions})
-        return r.json()
+        return self._request_json('POST',
+                                  f'/artifacts/{artifact_ref}/versions',
+                                  data={'max_versions': max_versions})
 
     def delete_artifact(self, artifact_ref):
-        r = self._request_url('DELETE', '/artifacts/' + artifact_ref)
-        return r.json()
+        return self._request_json('DELETE', f'/artifacts/{artifact_ref}')
 
     def delete_artifact_version(self, artifact_ref, version_id):
-        r = self._request_url('DELETE', '/artifacts/' + artifact_ref +
-                              '/versions/' + str(version_id))
-        return r.json()
+        return self._request_json('DELETE', f'/artifacts/{artifact_ref}/versions/{version_id}')
 
     def delete_all_artifacts(self, namespace):
         # Unlike instances and networks, artifact deletion isn't a task in the
         # backend, so we don't need to poll here.
-        r = self._request_url('DELETE', '/artifacts',
-                              data={'confirm': True,
-                                    'namespace': namespace})
-        return r.json()
+        return self._request_json('DELETE', '/artifacts',
+                                  data={'confirm': True,
+                                        'namespace': namespace})
 
     def share_artifact(self, artifact_ref):
-        r = self._request_url('POST', '/artifacts/' + artifact_ref + '/share')
-        return r.json()
+        return self._request_json('POST', f'/artifacts/{artifact_ref}/share')
 
     def unshare_artifact(self, artifact_ref):
-        r = self._request_url(
-            'POST', '/artifacts/' + artifact_ref + '/unshare')
-        return r.json()
+        return self._request_json(
+            'POST', f'/artifacts/{artifact_ref}/unshare')
 
     def get_blob(self, blob_uuid):
-        r = self._request_url('GET', '/blobs/' + blob_uuid)
-        return r.json()
+        return self._request_json('GET', f'/blobs/{blob_uuid}')
 
     def get_blob_by_sha512(self, sha512):
-        r = self._request_url('GET', '/blob_checksums/sha512/' + sha512)
-        return r.json()
+        return self._request_json('GET', f'/blob_checksums/sha512/{sha512}')
 
-    def get_blob_data(self, blob_uuid, offset=0, limit=0):
+    def get_blob_data(self, blob_uuid, offset=0, limit=0,
+                      chunk_size=BLOB_CHUNK_SIZE):
         supports_limits = self.check_capability('blob-data-limit')
         if limit != 0 and not supports_limits:
             raise IncapableException(
@@ -803,9 +1205,9 @@ class Client:
         if not supports_limits:
             # If we don't support limits, then we just do a simple single read.
             r = self._request_url(
-                'GET', '/blobs/' + blob_uuid + '/data?offset=' + str(offset),
+                'GET', f'/blobs/{blob_uuid}/data?offset={offset}',
                 stream=True)
-            for chunk in r.iter_content(chunk_size=8192):
+            for chunk in r.iter_content(chunk_size=chunk_size):
                 yield chunk
             return
 
@@ -815,11 +1217,10 @@ class Client:
         while True:
             r = self._request_url(
                 'GET',
-                ('/blobs/' + blob_uuid + '/data?offset=' + str(offset) +
-                 '&limit=' + str(limit)),
+                f'/blobs/{blob_uuid}/data?offset={offset}&limit={limit}',
                 stream=True)
             fetched = 0
-            for chunk in r.iter_content(chunk_size=8192):
+            for chunk in r.iter_content(chunk_size=chunk_size):
                 fetched += len(chunk)
                 yield chunk
 
@@ -827,12 +1228,20 @@ class Client:
                 return
 
     def get_blobs(self, node=None):
-        r = self._request_url('GET', '/blobs', data={'node': node})
-        return r.json()
+        return self._request_json('GET', '/blobs', data={'node': node})
+
+    def iter_blobs(self, node=None):
+        r = self._request_url('GET', '/blobs', data={'node': node},
+                              stream=True)
+        return _iter_json_array(r)
 
     def get_networks(self, all=False):
-        r = self._request_url('GET', '/networks', data={'all': all})
-        return r.json()
+        return self._request_json('GET', '/networks', data={'all': all})
+
+    def iter_networks(self, all=False):
+        r = self._request_url('GET', '/networks', data={'all': all},
+                              stream=True)
+        return _iter_json_array(r)
 
     def get_network(self, network_ref, namespace=None):
         if namespace and not self.check_capability('get-network-namespace'):
@@ -843,8 +1252,7 @@ class Client:
         data = None
         if namespace:
             data = {'namespace': namespace}
-        r = self._request_url('GET', '/networks/' + network_ref, data=data)
-        return r.json()
+        return self._request_json('GET', f'/networks/{network_ref}', data=data)
 
     def delete_network(self, network_ref, namespace=None):
         # Why pass a namespace when you're passing an exact UUID? The idea here
@@ -853,16 +1261,14 @@ class Client:
         data = None
         if namespace:
             data = {'namespace': namespace}
-        r = self._request_url('DELETE', '/networks/' + network_ref, data=data)
-        return r.json()
+        return self._request_json('DELETE', f'/networks/{network_ref}', data=data)
 
     def delete_all_networks(self, namespace, clean_wait=False):
-        r = self._request_url('DELETE', '/networks',
-                              data={'confirm': True,
-                                    'namespace': namespace,
-                                    'clean_wait': clean_wait,
-                                    })
-        return r.json()
+        return self._request_json('DELETE', '/networks',
+                                  data={'confirm': True,
+                                        'namespace': namespace,
+                                        'clean_wait': clean_wait,
+                                        })
 
     def allocate_network(self, netblock, provide_dhcp, provide_nat, name,
                          namespace=None, provide_dns=False):
@@ -881,25 +1287,27 @@ class Client:
         if provide_dns:
             data['provide_dns'] = provide_dns
 
-        r = self._request_url('POST', '/networks', data=data)
-        n = r.json()
+        n = self._request_json('POST', '/networks', data=data)
+        if self.async_strategy == ASYNC_CONTINUE:
+            return n
 
         deadline = time.time() + _calculate_async_deadline(self.async_strategy)
+        attempt = 0
         while True:
-            if n['state'] not in ['initial', 'creating']:
+            if n['state'] not in PENDING_STATES:
                 return n
 
-            LOG.debug('Waiting for network to be created')
+            self.log.debug('Waiting for network to be created')
             if time.time() > deadline:
-                LOG.debug('Deadline exceeded waiting for network to be created')
+                self.log.debug('Deadline exceeded waiting for network to be created')
                 return n
 
-            time.sleep(1)
+            time.sleep(_poll_delay(attempt, deadline))
+            attempt += 1
             n = self.get_network(n['uuid'])
 
     def get_network_interfaces(self, network_ref):
-        r = self._request_url('GET', '/networks/' + network_ref + '/interfaces')
-        return r.json()
+        return self._request_json('GET', f'/networks/{network_ref}/interfaces')
 
     def get_network_addresses(self, network_ref):
         if not self.check_capability('list-addresses'):
@@ -907,8 +1315,7 @@ class Client:
                 'The API server version you are talking to does not support '
                 'listing network addresses.')
 
-        r = self._request_url('GET', '/networks/' + network_ref + '/addresses')
-        return r.json()
+        return self._request_json('GET', f'/networks/{network_ref}/addresses')
 
     def route_network_address(self, network_ref):
         if not self.check_capability('route-addresses'):
@@ -916,8 +1323,7 @@ class Client:
                 'The API server version you are talking to does not support '
                 'routing addresses.')
 
-        r = self._request_url('POST', '/networks/' + network_ref + '/route')
-        return r.json()
+        return self._request_json('POST', f'/networks/{network_ref}/route')
 
     def unroute_network_address(self, network_ref, address):
         if not self.check_capability('route-addresses'):
@@ -926,7 +1332,7 @@ class Client:
                 'routing addresses.')
 
         self._request_url(
-            'DELETE', '/networks/' + network_ref + '/route' + '/' + address)
+            'DELETE', f'/networks/{network_ref}/route/{address}')
 
     def update_network_dns_entry(self, network_ref, name, value):
         if not self.check_capability('extra-dns-entries'):
@@ -935,7 +1341,7 @@ class Client:
                 'managing extra DNS entries.')
 
         self._request_url(
-            'POST', '/networks/' + network_ref + '/dns',
+            'POST', f'/networks/{network_ref}/dns',
             data={
                 'name': name,
                 'value': value
@@ -948,7 +1354,7 @@ class Client:
                 'managing extra DNS entries.')
 
         self._request_url(
-            'DELETE', '/networks/' + network_ref + '/dns',
+            'DELETE', f'/networks/{network_ref}/dns',
             data={
                 'name': name
             })
@@ -958,61 +1364,55 @@ class Client:
             raise IncapableException(
                 'The API server version you are talking to does not support '
                 'showing a single node, try "node list" instead.')
-        r = self._request_url('GET', '/nodes/' + node)
-        return r.json()
+        return self._request_json('GET', f'/nodes/{node}')
 
     def get_nodes(self):
-        r = self._request_url('GET', '/nodes')
-        return r.json()
+        return self._request_json('GET', '/nodes')
 
     def delete_node(self, node):
-        r = self._request_url('DELETE', '/nodes/' + node)
-        return r.json()
+        return self._request_json('DELETE', f'/nodes/{node}')
 
     def get_node_process_metrics(self, node):
         if not self.check_capability('node-process-metrics'):
             raise IncapableException(
                 'The API server version you are talking to does not support '
                 'fetching process metrics for a node.')
-        r = self._request_url('GET', '/nodes/' + node + '/processmetrics')
-        return r.json()
+        return self._request_json('GET', f'/nodes/{node}/processmetrics')
 
     def get_interface(self, interface_uuid):
-        r = self._request_url('GET', '/interfaces/' + interface_uuid)
-        return r.json()
+        return self._request_json('GET', f'/interfaces/{interface_uuid}')
 
     def float_interface(self, interface_uuid):
-        r = self._request_url('POST', '/interfaces/' + interface_uuid +
-                              '/float')
-        return r.json()
+        return self._request_json('POST', f'/interfaces/{interface_uuid}/float')
 
     def defloat_interface(self, interface_uuid):
-        r = self._request_url('POST', '/interfaces/' + interface_uuid +
-                              '/defloat')
-        return r.json()
+        return self._request_json('POST', f'/interfaces/{interface_uuid}/defloat')
 
-    def get_console_data(self, instance_ref, length=None, decode='utf-8'):
-        url = '/instances/' + instance_ref + '/consoledata'
+    def get_console_data(self, instance_ref, length=None, decode='utf-8',
+                         raw=False):
+        url = f'/instances/{instance_ref}/consoledata'
         if length:
             d = {'length': length}
         else:
             d = {}
         r = self._request_url('GET', url, data=d)
 
-        out = r.text
-        if decode:
-            try:
-                out = out.decode(decode)
-            except Exception:
-                pass
-        return out
+        # Decode the body ourselves rather than letting requests guess its
+        # encoding. Console output can contain invalid sequences, which are
+        # replaced rather than failing the call. Callers who want the bytes
+        # as sent ask for raw.
+        if raw:
+            return r.content
+        if not decode:
+            return r.text
+        return r.content.decode(decode, errors='replace')
 
     def delete_console_data(self, instance_ref):
-        url = '/instances/' + instance_ref + '/consoledata'
+        url = f'/instances/{instance_ref}/consoledata'
         self._request_url('DELETE', url)
 
     def get_vdi_console_helper(self, instance_ref):
-        r = self._request_url('GET', '/instances/' + instance_ref + '/vdiconsolehelper')
+        r = self._request_url('GET', f'/instances/{instance_ref}/vdiconsolehelper')
         return r.text
 
     def get_screenshot(self, instance_ref):
@@ -1021,21 +1421,23 @@ class Client:
                 'The API server version you are talking to does not support '
                 'fetching a screenshot of an instance.')
 
-        r = self._request_url('GET', '/instances/' + instance_ref + '/screenshot')
-        return self.get_blob_data(r.json())
+        return self.get_blob_data(
+            self._request_json('GET', f'/instances/{instance_ref}/screenshot'))
 
     def _await_agentop(self, r):
         deadline = time.time() + _calculate_async_deadline(self.async_strategy)
+        attempt = 0
         while True:
             if r['state'] == 'complete':
                 return r
 
-            LOG.debug('Waiting for agent operation to be complete')
+            self.log.debug('Waiting for agent operation to be complete')
             if time.time() > deadline:
-                LOG.debug('Deadline exceeded waiting for agent operation to complete')
+                self.log.debug('Deadline exceeded waiting for agent operation to complete')
                 return r
 
-            time.sleep(1)
+            time.sleep(_poll_delay(attempt, deadline))
+            attempt += 1
             r = self.get_agent_operation(r['uuid'])
 
     def instance_put_blob(self, instance_ref, blob_uuid, path, mode):
@@ -1044,9 +1446,9 @@ class Client:
                 'The API server version you are talking to does not support '
                 'placing a blob on an instance.')
 
-        r = self._request_url('POST', '/instances/' + instance_ref + '/agent/put',
-                              data={'blob_uuid': blob_uuid, 'path': path, 'mode': mode})
-        return self._await_agentop(r.json())
+        return self._await_agentop(self._request_json(
+            'POST', f'/instances/{instance_ref}/agent/put',
+            data={'blob_uuid': blob_uuid, 'path': path, 'mode': mode}))
 
     def instance_execute(self, instance_ref, command_line):
         if not self.check_capability('instance-execute'):
@@ -1054,9 +1456,9 @@ class Client:
                 'The API server version you are talking to does not support '
                 'executing a command within an instance.')
 
-        r = self._request_url('POST', '/instances/' + instance_ref + '/agent/execute',
-                              data={'command_line': command_line})
-        return self._await_agentop(r.json())
+        return self._await_agentop(self._request_json(
+            'POST', f'/instances/{instance_ref}/agent/execute',
+            data={'command_line': command_line}))
 
     def instance_get(self, instance_ref, path):
         if not self.check_capability('instance-get'):
@@ -1064,73 +1466,61 @@ class Client:
                 'The API server version you are talking to does not support '
                 'fetching a file from within an instance.')
 
-        r = self._request_url('POST', '/instances/' + instance_ref + '/agent/get',
-                              data={'path': path})
-        return self._await_agentop(r.json())
+        return self._await_agentop(self._request_json(
+            'POST', f'/instances/{instance_ref}/agent/get',
+            data={'path': path}))
 
     def get_namespaces(self):
-        r = self._request_url('GET', '/auth/namespaces')
-        return r.json()
+        return self._request_json('GET', '/auth/namespaces')
 
     def get_namespace(self, namespace):
-        r = self._request_url('GET', '/auth/namespaces/' + namespace)
-        return r.json()
+        return self._request_json('GET', f'/auth/namespaces/{namespace}')
 
     def create_namespace(self, namespace):
-        r = self._request_url('POST', '/auth/namespaces',
-                              data={'namespace': namespace})
-        return r.json()
+        return self._request_json('POST', '/auth/namespaces',
+                                  data={'namespace': namespace})
 
     def delete_namespace(self, namespace):
         if not namespace:
             namespace = self.namespace
-        self._request_url('DELETE', '/auth/namespaces/' + namespace)
+        self._request_url('DELETE', f'/auth/namespaces/{namespace}')
 
     def get_namespace_keynames(self, namespace):
-        r = self._request_url('GET', '/auth/namespaces/' + namespace + '/keys')
-        return r.json()
+        return self._request_json('GET', f'/auth/namespaces/{namespace}/keys')
 
     def add_namespace_key(self, namespace, key_name, key):
-        r = self._request_url('POST', '/auth/namespaces/' + namespace + '/keys',
-                              data={'key_name': key_name, 'key': key})
-        return r.json()
+        return self._request_json('POST', f'/auth/namespaces/{namespace}/keys',
+                                  data={'key_name': key_name, 'key': key})
 
     def update_namespace_key(self, namespace, key_name, key):
-        r = self._request_url('PUT', '/auth/namespaces/' + namespace + '/keys',
-                              data={'key_name': key_name, 'key': key})
-        return r.json()
+        return self._request_json('PUT', f'/auth/namespaces/{namespace}/keys',
+                                  data={'key_name': key_name, 'key': key})
 
     def delete_namespace_key(self, namespace, key_name):
         self._request_url(
-            'DELETE', '/auth/namespaces/' + namespace + '/keys/' + key_name)
+            'DELETE', f'/auth/namespaces/{namespace}/keys/{key_name}')
 
     def add_namespace_trust(self, namespace, trusted_namespace):
-        r = self._request_url('POST', '/auth/namespaces/' + namespace + '/trust',
-                              data={'external_namespace': trusted_namespace})
-        return r.json()
+        return self._request_json('POST', f'/auth/namespaces/{namespace}/trust',
+                                  data={'external_namespace': trusted_namespace})
 
     def remove_namespace_trust(self, namespace, trusted_namespace):
-        r = self._request_url(
-            'DELETE', '/auth/namespaces/' + namespace + '/trust/' + trusted_namespace)
-        return r.json()
+        return self._request_json(
+            'DELETE', f'/auth/namespaces/{namespace}/trust/{trusted_namespace}')
 
     def get_existing_locks(self):
-        r = self._request_url('GET', '/admin/locks')
-        return r.json()
+        return self._request_json('GET', '/admin/locks')
 
     def ping(self, network_ref, address):
-        r = self._request_url(
-            'GET', '/networks/' + network_ref + '/ping/' + address)
-        return r.json()
+        return self._request_json(
+            'GET', f'/networks/{network_ref}/ping/{address}')
 
     def create_upload(self):
-        r = self._request_url('POST', '/upload')
-        return r.json()
+        return self._request_json('POST', '/upload')
 
     def send_upload(self, upload_uuid, data):
-        r = self._request_url('POST', '/upload/' + upload_uuid,
-                              data=data, request_body_is_binary=True)
-        return r.json()
+        return self._request_json('POST', f'/upload/{upload_uuid}',
+                                  data=data, request_body_is_binary=True)
 
     def send_upload_file(self, upload_uuid, flo):
         buffer_size = 4096
@@ -1170,9 +1560,8 @@ class Client:
             d = flo.read(buffer_size)
 
     def truncate_upload(self, upload_uuid, offset):
-        r = self._request_url(
-            'POST', '/upload/' + upload_uuid + '/truncate/' + str(offset))
-        return r.json()
+        return self._request_json(
+            'POST', f'/upload/{upload_uuid}/truncate/{offset}')
 
     def get_agent_operation(self, operation_uuid):
         if not self.check_capability('agentoperations-crud'):
@@ -1180,8 +1569,7 @@ class Client:
                 'The API server version you are talking to does not support '
                 'agent operations.')
 
-        r = self._request_url('GET', '/agentoperations/' + operation_uuid)
-        return r.json()
+        return self._request_json('GET', f'/agentoperations/{operation_uuid}')
 
     def delete_agent_operation(self, operation_uuid):
         if not self.check_capability('agentoperations-crud'):
@@ -1189,7 +1577,7 @@ class Client:
                 'The API server version you are talking to does not support '
                 'agent operations.')
 
-        self._request_url('DELETE', '/agentoperations/' + operation_uuid)
+        self._request_url('DELETE', f'/agentoperations/{operation_uuid}')
 
     def get_cluster_cacert(self):
         if not self.check_capability('cluster-cacert'):
@@ -1200,17 +1588,22 @@ class Client:
         return r.text
 
     # The following methods are convenience wrappers around methods above.
-    def await_instance_create(self, instance_uuid, timeout=600):
+    def await_instance_create(self, instance_uuid, timeout=600, poll_interval=0.5,
+                              poll_max=5):
         # Wait up to 5 minutes for the instance to be created. On a slow
-        # morning it can take over 2 minutes to download a Ubuntu image.
+        # morning it can take over 2 minutes to download a Ubuntu image. We
+        # start polling quickly so that fast creates return promptly, and then
+        # back off to poll_max seconds between polls for slow ones.
         start_time = time.time()
         final = False
+        interval = poll_interval
         while time.time() - start_time < timeout:
             i = self.get_instance(instance_uuid)
-            if i['state'] in ['created', 'error']:
+            if i['state'] == 'created' or i['state'].endswith('error'):
                 final = True
                 break
-            time.sleep(5)
+            time.sleep(interval)
+            interval = min(interval * 1.5, poll_max)
 
         if i['state'].endswith('-error'):
             raise InstanceWillNeverBeReady(
@@ -1219,6 +1612,7 @@ class Client:
         if not final:
             raise TimeoutException(
                 'not created within %d second timeout' % timeout)
+        return i
 
     def _instance_await_sanity_check(self, inst):
         if not inst:
@@ -1318,10 +1712,11 @@ class Client:
                 time.sleep(5)
                 b = self.get_blob(op['results']['0']['stdout_blob'])
 
-            # Fetch the blob containing stdout
-            data = ''
-            for chunk in self.get_blob_data(op['results']['0']['stdout_blob']):
-                data += chunk.decode('utf-8')
+            # Fetch the blob containing stdout. Chunks are joined before
+            # decoding, which avoids quadratic string concatenation and
+            # splitting multi-byte characters at chunk boundaries.
+            data = b''.join(self.get_blob_data(
+                op['results']['0']['stdout_blob'])).decode('utf-8')
 
         if exit_code not in exit_codes:
             raise AgentCommandError(
@@ -1367,9 +1762,8 @@ class Client:
             b = self.get_blob(op['results']['0']['content_blob'])
 
         # Fetch the blob containing the file
-        data = ''
-        for chunk in self.get_blob_data(op['results']['0']['content_blob']):
-            data += chunk.decode('utf-8')
+        data = b''.join(self.get_blob_data(
+            op['results']['0']['content_blob'])).decode('utf-8')
 
         return data
 
@@ -1390,7 +1784,7 @@ class Client:
                 'interface not found in `ip -json link` output:\n%s' % data)
 
         # Determine which interface the new one was added as
-        d = json.loads(data)
+        d = _json_loads(data)
         new_interface = None
         for i in d:
             if i['address'] == netdesc['macaddr']:
@@ -1405,11 +1799,14 @@ class Client:
         # Ensure interface picked up the right address
         _, data = self._await_agent_command(
             instance_uuid, f'ip -json -o addr show dev {new_interface}')
-        d = json.loads(data)
+        d = _json_loads(data)
         if d[0]['addr_info'][0]['local'] != netdesc['ipv4']:
             raise AgentCommandError('wrong address assigned to interface')
 
 
+@functools.lru_cache(maxsize=1)
 def get_user_agent():
+    # Looking up our version walks package metadata, and it cannot change
+    # while we are running.
     sf_version = VersionInfo('shakenfist_client').version_string()
     return 'Mozilla/5.0 (Ubuntu; Linux x86_64) Shaken Fist/%s' % sf_version
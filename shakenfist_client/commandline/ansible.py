@@ -1,3 +1,4 @@
+import atexit
 import json
 import sys
 import time
@@ -6,6 +7,20 @@ import click
 
 from shakenfist_client import apiclient
 
+try:
+    import orjson
+
+    def json_dumps(obj):
+        return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS).decode('utf-8')
+
+    json_loads = orjson.loads
+
+except ImportError:
+    def json_dumps(obj):
+        return json.dumps(obj, separators=(',', ':'))
+
+    json_loads = json.loads
+
 
 @click.group(help='Ansible commands, intended to be used as modules')
 def ansible():
@@ -18,47 +33,70 @@ def ansible():
 
 
 def _make_client(client):
-    # We need a quiet and patient blocking client
+    # We need a quiet and patient blocking client. It shares the session of
+    # the command line client so that connections to the API server are
+    # reused rather than re-established.
     return apiclient.Client(
         base_url=client.base_url, verbose=False, namespace=client.namespace,
         key=client.key, sync_request_timeout=1800,
         suppress_configuration_lookup=True,
-        async_strategy=apiclient.ASYNC_BLOCK)
+        async_strategy=apiclient.ASYNC_BLOCK, session=client.session)
 
 
 LOG = []
 
+# Log lines are echoed to stderr in batches rather than one write per line.
+STDERR_BUFFER = []
+STDERR_BUFFER_LINES = 16
+
+
+def _flush_log():
+    if STDERR_BUFFER:
+        sys.stderr.write(''.join(STDERR_BUFFER))
+        STDERR_BUFFER.clear()
+
+
+atexit.register(_flush_log)
+
 
 def _result(changed, error, meta, error_msg=None):
+    # Our output is parsed by Ansible, not read by people, so there is no
+    # value in pretty printing it.
     global LOG
-    sys.stdout.write(json.dumps(
+    _flush_log()
+    sys.stdout.write(json_dumps(
         {
             'changed': changed,
             'failed': error,
             'meta': meta,
             'log': LOG,
             'msg': error_msg
-        }, indent=4, sort_keys=True
+        }
     ))
 
 
 def _log(msg):
     global LOG
     LOG.append(msg)
-    sys.stderr.write(msg)
-    sys.stderr.write('\n')
+    STDERR_BUFFER.append('%s\n' % msg)
+    if len(STDERR_BUFFER) >= STDERR_BUFFER_LINES:
+        _flush_log()
 
 
-@ansible.command(name='namespace', help='Namespace module')
-@click.argument('args', type=click.Path(exists=True))
-@click.pass_context
-def namespace(ctx, args):
+def _load_input(path):
     global LOG
     LOG = []
-    with open(args) as f:
+    with open(path) as f:
         input = f.read()
         _log('Input was: %s' % input)
-        input = json.loads(input)
+        return json_loads(input)
+
+
+@ansible.command(name='namespace', help='Namespace module')
+@click.argument('args', type=click.Path(exists=True))
+@click.pass_context
+def namespace(ctx, args):
+    input = _load_input(args)
 
     state = input.get('state', 'present')
     client = _make_client(ctx.obj['CLIENT'])
@@ -127,12 +165,7 @@ def namespace(ctx, args):
 @click.argument('args', type=click.Path(exists=True))
 @click.pass_context
 def network(ctx, args):
-    global LOG
-    LOG = []
-    with open(args) as f:
-        input = f.read()
-        _log('Input was: %s' % input)
-        input = json.loads(input)
+    input = _load_input(args)
 
     state = input.get('state', 'present')
     client = _make_client(ctx.obj['CLIENT'])
@@ -293,6 +326,19 @@ class InstanceCreationException(Exception):
     ...
 
 
+def _parse_spec(kind, spec):
+    # Network and disk specifications are both comma separated lists of
+    # key=value pairs.
+    defn = {}
+    for elem in spec.split(','):
+        s = elem.split('=')
+        if len(s) != 2:
+            raise InstanceCreationException(
+                '%s specification should be key=value not %s' % (kind, elem))
+        defn[s[0]] = s[1]
+    return defn
+
+
 def _check_instance(client, existing, input):
     dirty = False
     instance_args = []
@@ -338,18 +384,9 @@ def _check_instance(client, existing, input):
         })
 
     for n in input.get('networkspecs', []):
-        defn = {}
-        for elem in n.split(','):
-            s = elem.split('=')
-            if len(s) != 2:
-                raise InstanceCreationException(
-                    'network specification should be key=value not %s' % elem)
-            if s[0] == 'float':
-                try:
-                    s[1] = bool(s[1])
-                except ValueError:
-                    raise InstanceCreationException('float must be a boolean')
-            defn[s[0]] = s[1]
+        defn = _parse_spec('network', n)
+        if 'float' in defn:
+            defn['float'] = bool(defn['float'])
         requested_networks.append(defn)
 
     # Painful dirtiness comparison...
@@ -414,20 +451,13 @@ def _check_instance(client, existing, input):
             'size': None,
             'type': 'disk'
         }
-        for elem in d.split(','):
-            s = elem.split('=')
-            if len(s) != 2:
+        defn.update(_parse_spec('disk', d))
+        if defn['size'] is not None:
+            try:
+                defn['size'] = int(defn['size'])
+            except ValueError:
                 raise InstanceCreationException(
-                    'disk specification should be key=value not %s' % elem)
-
-            if s[0] == 'size':
-                try:
-                    s[1] = int(s[1])
-                except ValueError:
-                    raise InstanceCreationException(
-                        'disk size must be an integer')
-
-            defn[s[0]] = s[1]
+                    'disk size must be an integer')
         requested_disks.append(defn)
 
     # Cleanup existing disk specifications. disk_base is an internal representation
@@ -458,16 +488,25 @@ def _check_instance(client, existing, input):
         else:
             instance_args.append(None)
 
-    # Does the instance definition specify optional single string values?
-    for key in ['placement', 'video', 'nvram_template', 'configdrive', 'namespace']:
-        if key in input:
-            if existing.get(key) != input[key]:
-                _log('Instance dirty: %s has changed' % key)
-                dirty = True
+    # Does the instance definition specify optional single values? Each entry
+    # is the input key, the create_instance() keyword argument it maps to, and
+    # whether the value is a boolean flag.
+    for key, kwarg, is_flag in [('placement', 'force_placement', False),
+                                ('video', 'video', False),
+                                ('nvram_template', 'nvram_template', False),
+                                ('configdrive', 'configdrive', False),
+                                ('namespace', 'namespace', False),
+                                ('uefi', 'uefi', True),
+                                ('secureboot', 'secure_boot', True)]:
+        if key not in input:
+            continue
 
-            if key == 'placement':
-                key == 'force_placement'
-            instance_kwargs[key] = input[key]
+        if is_flag:
+            input[key] = bool(input[key])
+        if existing.get(key) != input[key]:
+            _log('Instance dirty: %s has changed' % key)
+            dirty = True
+        instance_kwargs[kwarg] = input[key]
 
     # What about optional values which might be a list of strings?
     for key in ['side_channels']:
@@ -478,22 +517,6 @@ def _check_instance(client, existing, input):
 
         instance_kwargs[key] = values
 
-    # Does the instance definition specify optional single boolean values?
-    for key in ['uefi', 'secureboot']:
-        if key in input:
-            try:
-                input[key] = bool(input[key])
-            except ValueError:
-                raise InstanceCreationException('%s must be a boolean' % key)
-
-            if existing.get(key) != input[key]:
-                _log('Instance dirty: %s has changed' % key)
-                dirty = True
-
-            if key == 'placement':
-                key == 'force_placement'
-            instance_kwargs[key] = input[key]
-
     # Metadata is a dict
     metadata = {}
     for k, v in input.get('metadata', {}).items():
@@ -511,12 +534,7 @@ def _check_instance(client, existing, input):
 @click.argument('args', type=click.Path(exists=True))
 @click.pass_context
 def instance(ctx, args):
-    global LOG
-    LOG = []
-    with open(args) as f:
-        input = f.read()
-        _log('Input was: %s' % input)
-        input = json.loads(input)
+    input = _load_input(args)
 
     state = input.get('state', 'present')
     client = _make_client(ctx.obj['CLIENT'])
@@ -573,20 +591,27 @@ def instance(ctx, args):
 
             i = client.create_instance(*instance_args, **instance_kwargs)
 
+        # Our client blocks on creation, so the instance we hold is already
+        # current and in most cases already created. Only poll if the caller
+        # asked us to and the instance is not yet in a final state.
         if not input.get('await', False):
             _log('Not awaiting instance')
+        elif i['state'] == 'created':
+            _log('Instance %s is already created' % i['uuid'])
         else:
             _log('Awaiting instance %s' % i['uuid'])
             try:
-                client.await_instance_create(
-                    i['uuid'], timeout=input.get('await_timeout', 600))
+                i = client.await_instance_create(
+                    i['uuid'], timeout=input.get('await_timeout', 600),
+                    poll_interval=input.get('poll_interval', 0.5),
+                    poll_max=input.get('poll_max', 5))
             except Exception as e:
                 _log('Waiting for instance failed: %s' % e)
                 return _result(
                     needs_replacement, True, None,
                     error_msg={'error': 'Waiting for instance failed: %s' % e})
 
-        return _result(needs_replacement, False, client.get_instance(i['uuid']))
+        return _result(needs_replacement, False, i)
 
     if state == 'absent':
         try:
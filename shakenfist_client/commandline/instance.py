@@ -33,6 +33,13 @@ def _get_interfaces(ctx, instance):
         return []
 
 
+def _get_all_interfaces(ctx, instances):
+    # Each instance without embedded interfaces costs a request, so make
+    # those requests concurrently. Results are in the same order as instances.
+    return util.get_client(ctx).executor.map(
+        lambda i: _get_interfaces(ctx, i), instances)
+
+
 def _convert_metadata(key, value):
     RESERVED_TAGS = ['tags', 'affinity']
     if key in RESERVED_TAGS:
@@ -59,9 +66,9 @@ def instance_list(ctx, all=False):
                          'power state', 'state', 'interfaces']
         x.align['interfaces'] = 'l'
 
-        for i in insts:
+        for i, interfaces in zip(insts, _get_all_interfaces(ctx, insts)):
             ifaces = []
-            for interface in _get_interfaces(ctx, i):
+            for interface in interfaces:
                 iface = (f"{interface['order']}: "
                          f"{interface.get('ipv4', 'No address assigned')}")
                 if interface.get('floating'):
@@ -77,9 +84,9 @@ def instance_list(ctx, all=False):
     elif ctx.obj['OUTPUT'] == 'simple':
         print('uuid,name,namespace,cpus,memory,hypervisor,power state,state,'
               'interfaces')
-        for i in insts:
+        for i, interfaces in zip(insts, _get_all_interfaces(ctx, insts)):
             ifaces = []
-            for interface in _get_interfaces(ctx, i):
+            for interface in interfaces:
                 iface = f"{interface['order']}:{interface.get('ipv4', 'None')}"
                 if interface.get('floating'):
                     iface += '({})'.format(interface['floating'])
@@ -93,8 +100,8 @@ def instance_list(ctx, all=False):
 
     elif ctx.obj['OUTPUT'] == 'json':
         export_insts = []
-        for i in insts:
-            i['interfaces'] = _get_interfaces(ctx, i)
+        for i, interfaces in zip(insts, _get_all_interfaces(ctx, insts)):
+            i['interfaces'] = interfaces
             export_insts.append(i)
         print(json.dumps({'instances': export_insts},
                          indent=4, sort_keys=True))
@@ -31,41 +31,46 @@ class GroupCatchExceptions(click.Group):
             return self.main(*args, **kwargs)
 
         except apiclient.RequestMalformedException as e:
-            LOG.error('Malformed Request: %s' % error_text(e.text))
+            LOG.error('Malformed Request: %s', error_text(e.text))
             sys.exit(1)
 
         except apiclient.UnauthenticatedException as e:
-            LOG.error('Not authenticated: %s' % e)
+            LOG.error('Not authenticated: %s', e)
             sys.exit(1)
 
         except apiclient.UnauthorizedException as e:
-            LOG.error('Not authorized: %s' % error_text(e.text))
+            LOG.error('Not authorized: %s', error_text(e.text))
             sys.exit(1)
 
         except apiclient.ResourceNotFoundException as e:
-            LOG.error('Resource not found: %s' % error_text(e.text))
+            LOG.error('Resource not found: %s', error_text(e.text))
             sys.exit(1)
 
         except apiclient.DependenciesNotReadyException as e:
-            LOG.error('Dependencies not ready: %s' % error_text(e.text))
+            LOG.error('Dependencies not ready: %s', error_text(e.text))
             sys.exit(1)
 
         except apiclient.ResourceStateConflictException as e:
-            LOG.error('Resource state conflict: %s' % error_text(e.text))
+            LOG.error('Resource state conflict: %s', error_text(e.text))
             sys.exit(1)
 
         except apiclient.InternalServerError as e:
             # Print full error since server should not fail
-            LOG.error('Internal Server Error: %s' % e.text)
+            LOG.error('Internal Server Error: %s', e.text)
             sys.exit(1)
 
         except apiclient.InsufficientResourcesException as e:
-            LOG.error('Insufficient Resources: %s' %
-                      error_text(e.text))
+            LOG.error('Insufficient Resources: %s', error_text(e.text))
+            sys.exit(1)
+
+        except (apiclient.RateLimitedException,
+                apiclient.ServiceUnavailableException,
+                apiclient.GatewayTimeoutException) as e:
+            LOG.error('Server busy, gave up retrying: %s', error_text(e.text))
             sys.exit(1)
 
         except apiclient.requests.exceptions.ConnectionError as e:
-            LOG.error('Unable to connect to server: %s' % e)
+            LOG.error('Unable to connect to server: %s', e)
             sys.exit(1)
 
 
@@ -109,9 +114,10 @@ def cli(ctx, output, verbose, namespace, key, apiurl, async_strategy):
         key=key,
         base_url=apiurl,
         logger=LOG,
-        async_strategy=async_strategy)
+        async_strategy=async_strategy,
+        persistent_cache=True)
     ctx.obj['CLIENT'] = CLIENT
-    LOG.debug('Client for %s constructed' % apiurl)
+    LOG.debug('Client for %s constructed', apiurl)
 
 
 @cli.command(name='version', help='Output the version of the client')
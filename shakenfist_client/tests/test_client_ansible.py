@@ -0,0 +1,27 @@
+import inspect
+from unittest import mock
+
+import testtools
+
+from shakenfist_client import apiclient
+from shakenfist_client.commandline import ansible
+
+
+class CheckInstanceTestCase(testtools.TestCase):
+    @mock.patch('shakenfist_client.commandline.ansible._log')
+    def test_optional_values_map_to_create_instance(self, mock_log):
+        dirty, args, kwargs = ansible._check_instance(
+            mock.MagicMock(), {},
+            {'name': 'inst', 'cpu': 1, 'ram': 1024, 'placement': 'sf-1',
+             'secureboot': 1, 'uefi': 0, 'namespace': 'space'})
+
+        self.assertTrue(dirty)
+        self.assertEqual(
+            {'force_placement': 'sf-1', 'secure_boot': True, 'uefi': False,
+             'namespace': 'space', 'side_channels': []},
+            kwargs)
+
+        # These used to be passed through under their input names, which
+        # create_instance() rejected with a TypeError.
+        inspect.signature(apiclient.Client.create_instance).bind(
+            None, *args, **kwargs)
@@ -1,11 +1,26 @@
+import base64
+import io
 import json
+import logging
+import os
+import shutil
+import tempfile
+import time
 from unittest import mock
 
+import requests
 import testtools
+import urllib3
 
 from shakenfist_client import apiclient
 
 
+def _response(body):
+    r = mock.MagicMock()
+    r.content = json.dumps(body).encode('utf-8')
+    return r
+
+
 class ApiClientTestCase(testtools.TestCase):
     def setUp(self):
         super().setUp()
@@ -13,17 +28,77 @@ class ApiClientTestCase(testtools.TestCase):
         self.request_url = mock.patch(
             'shakenfist_client.apiclient.Client._request_url')
         self.mock_request = self.request_url.start()
+        self.mock_request.return_value = _response(
+            {'uuid': 'notreallyauuid', 'state': 'created'})
         self.addCleanup(self.request_url.stop)
 
         self.capabilities = mock.patch(
             'shakenfist_client.apiclient.Client._collect_capabilities')
-        self.capabilities = self.capabilities.start()
+        self.mock_capabilities = self.capabilities.start()
         self.addCleanup(self.capabilities.stop)
 
         self.sleep = mock.patch('time.sleep')
         self.mock_sleep = self.sleep.start()
         self.addCleanup(self.sleep.stop)
 
+    def test_context_manager_leaves_borrowed_session_open(self):
+        session = mock.MagicMock()
+        with apiclient.Client(suppress_configuration_lookup=True,
+                              base_url='http://localhost:13000',
+                              session=session) as client:
+            self.assertEqual(session, client.session)
+        session.close.assert_not_called()
+
+    @mock.patch('shakenfist_client.apiclient._make_session')
+    def test_context_manager_closes_owned_session(self, mock_make_session):
+        with apiclient.Client(suppress_configuration_lookup=True,
+                              base_url='http://localhost:13000') as client:
+            self.assertEqual(mock_make_session.return_value, client.session)
+        mock_make_session.return_value.close.assert_called_once_with()
+
+    def test_cached_auth_headers(self):
+        client = apiclient.Client(suppress_configuration_lookup=True,
+                                  base_url='http://localhost:13000')
+        client.cached_auth = 'Bearer token'
+        self.assertEqual({'Authorization': 'Bearer token',
+                          'User-Agent': apiclient.get_user_agent()},
+                         client._auth_headers)
+        self.assertEqual({'Authorization': 'Bearer token',
+                          'User-Agent': apiclient.get_user_agent(),
+                          'Content-Type': 'application/json'},
+                         client._json_headers)
+
+    def test_borrowed_session_sends_user_agent(self):
+        session = mock.MagicMock()
+        session.request.return_value.status_code = 200
+        client = apiclient.Client(suppress_configuration_lookup=True,
+                                  base_url='http://localhost:13000',
+                                  session=session)
+        client.cached_auth = 'Bearer token'
+        client._actual_request_url('GET', '/nodes')
+        self.assertEqual(
+            apiclient.get_user_agent(),
+            session.request.call_args[1]['headers']['User-Agent'])
+
+    def test_verbose_only_affects_own_logger(self):
+        logger = mock.MagicMock()
+        client = apiclient.Client(suppress_configuration_lookup=True,
+                                  base_url='http://localhost:13000',
+                                  logger=logger, verbose=True)
+        self.assertEqual(logger, client.log)
+        logger.setLevel.assert_called_once_with(logging.DEBUG)
+        self.assertNotEqual(logging.DEBUG, apiclient.LOG.level)
+
+    def test_check_capability_memoized(self):
+        client = apiclient.Client(suppress_configuration_lookup=True,
+                                  base_url='http://localhost:13000')
+        client.root_html = 'blob-data-limit events-by-type'
+        client._capabilities = {}
+        self.assertTrue(client.check_capability('blob-data-limit'))
+        self.assertFalse(client.check_capability('node-get'))
+        self.assertEqual({'blob-data-limit': True, 'node-get': False},
+                         client._capabilities)
+
     def test_get_instances(self):
         client = apiclient.Client(suppress_configuration_lookup=True,
                                   base_url='http://localhost:13000')
@@ -32,6 +107,17 @@ class ApiClientTestCase(testtools.TestCase):
         self.mock_request.assert_called_with(
             'GET', '/instances', data={'all': False})
 
+    def test_iter_instances(self):
+        client = apiclient.Client(suppress_configuration_lookup=True,
+                                  base_url='http://localhost:13000')
+        self.mock_request.return_value.content = b'[{"uuid": "a"}]'
+        self.mock_request.return_value.raw = io.BytesIO(b'[{"uuid": "a"}]')
+        self.assertEqual([{'uuid': 'a'}], list(client.iter_instances()))
+
+        self.mock_request.assert_called_with(
+            'GET', '/instances', data={'all': False}, stream=True)
+        self.mock_request.return_value.close.assert_called_once_with()
+
     def test_get_instance(self):
         client = apiclient.Client(suppress_configuration_lookup=True,
                                   base_url='http://localhost:13000')
@@ -40,6 +126,28 @@ class ApiClientTestCase(testtools.TestCase):
         self.mock_request.assert_called_with(
             'GET', '/instances/notreallyauuid', data=None)
 
+    def test_await_instance_create_backoff(self):
+        client = apiclient.Client(suppress_configuration_lookup=True,
+                                  base_url='http://localhost:13000')
+        states = [{'state': 'initial'}, {'state': 'creating'},
+                  {'state': 'creating'}, {'state': 'created'}]
+        self.mock_request.side_effect = [_response(s) for s in states]
+        client.await_instance_create('notreallyauuid', poll_interval=0.5,
+                                     poll_max=1)
+
+        self.assertEqual(
+            [mock.call(0.5), mock.call(0.75), mock.call(1)],
+            self.mock_sleep.mock_calls)
+
+    def test_await_instance_create_error(self):
+        client = apiclient.Client(suppress_configuration_lookup=True,
+                                  base_url='http://localhost:13000')
+        self.mock_request.return_value = _response({
+            'state': 'creating-error'})
+        self.assertRaises(apiclient.InstanceWillNeverBeReady,
+                          client.await_instance_create, 'notreallyauuid')
+        self.mock_sleep.assert_not_called()
+
     def test_get_instance_interfaces(self):
         client = apiclient.Client(suppress_configuration_lookup=True,
                                   base_url='http://localhost:13000')
@@ -106,6 +214,7 @@ class ApiClientTestCase(testtools.TestCase):
     def test_snapshot_instance(self):
         client = apiclient.Client(suppress_configuration_lookup=True,
                                   base_url='http://localhost:13000')
+        self.mock_request.return_value = _response({})
         client.snapshot_instance('notreallyauuid', all=True)
 
         self.mock_request.assert_called_with(
@@ -168,6 +277,17 @@ class ApiClientTestCase(testtools.TestCase):
         self.mock_request.assert_called_with(
             'DELETE', '/instances/notreallyauuid', data=None)
 
+    def test_delete_instance_async_continue(self):
+        client = apiclient.Client(suppress_configuration_lookup=True,
+                                  base_url='http://localhost:13000',
+                                  async_strategy=apiclient.ASYNC_CONTINUE)
+        self.mock_request.return_value = _response({
+            'uuid': 'notreallyauuid', 'state': 'deleting'})
+        client.delete_instance('notreallyauuid')
+
+        self.mock_request.assert_called_once_with(
+            'DELETE', '/instances/notreallyauuid', data=None)
+
     def test_delete_all_instances(self):
         client = apiclient.Client(suppress_configuration_lookup=True,
                                   base_url='http://localhost:13000',
@@ -188,6 +308,20 @@ class ApiClientTestCase(testtools.TestCase):
             'DELETE', '/instances',
             data={'confirm': True, 'namespace': 'bobspace'})
 
+    def test_delete_all_instances_polls_listing(self):
+        client = apiclient.Client(suppress_configuration_lookup=True,
+                                  base_url='http://localhost:13000')
+        self.mock_request.side_effect = [
+            _response(['uuid1', 'uuid2']),
+            _response([{'uuid': 'uuid1', 'state': 'deleted'},
+                       {'uuid': 'uuid2', 'state': 'running'}]),
+            _response([{'uuid': 'uuid1', 'state': 'deleted'}])]
+        self.assertEqual(['uuid1', 'uuid2'], client.delete_all_instances(None))
+
+        self.mock_request.assert_called_with(
+            'GET', '/instances', data={'all': True})
+        self.assertEqual(3, self.mock_request.call_count)
+
     def test_cache_artifact(self):
         client = apiclient.Client(suppress_configuration_lookup=True,
                                   base_url='http://localhost:13000')
@@ -200,12 +334,49 @@ class ApiClientTestCase(testtools.TestCase):
     def test_get_artifacts(self):
         client = apiclient.Client(suppress_configuration_lookup=True,
                                   base_url='http://localhost:13000')
+        self.mock_request.return_value = _response([])
         client.get_artifacts('sf-2')
 
         self.mock_request.assert_called_with(
             'GET', '/artifacts',
             data={'node': 'sf-2'})
 
+    @mock.patch('shakenfist_client.apiclient.Client.check_capability',
+                return_value=False)
+    def test_get_blob_data_chunk_size(self, mock_capability):
+        client = apiclient.Client(suppress_configuration_lookup=True,
+                                  base_url='http://localhost:13000')
+        self.mock_request.return_value.iter_content.return_value = [b'a', b'b']
+        self.assertEqual(
+            [b'a', b'b'], list(client.get_blob_data('uuid', chunk_size=4096)))
+
+        self.mock_request.assert_called_with(
+            'GET', '/blobs/uuid/data?offset=0', stream=True)
+        self.mock_request.return_value.iter_content.assert_called_with(
+            chunk_size=4096)
+
+    def test_get_console_data(self):
+        client = apiclient.Client(suppress_configuration_lookup=True,
+                                  base_url='http://localhost:13000')
+        self.mock_request.return_value.content = b'login: \xe2\x9c\x93 \xff'
+        self.assertEqual('login: \u2713 \ufffd',
+                         client.get_console_data('uuid', length=10))
+        self.mock_request.assert_called_with(
+            'GET', '/instances/uuid/consoledata', data={'length': 10})
+
+    def test_get_console_data_without_decode(self):
+        client = apiclient.Client(suppress_configuration_lookup=True,
+                                  base_url='http://localhost:13000')
+        self.mock_request.return_value.text = 'login: '
+        self.assertEqual('login: ', client.get_console_data('uuid', decode=None))
+
+    def test_get_console_data_raw(self):
+        client = apiclient.Client(suppress_configuration_lookup=True,
+                                  base_url='http://localhost:13000')
+        self.mock_request.return_value.content = b'login: \xe2\x9c\x93 \xff'
+        self.assertEqual(b'login: \xe2\x9c\x93 \xff',
+                         client.get_console_data('uuid', raw=True))
+
     def test_create_namespace(self):
         client = apiclient.Client(suppress_configuration_lookup=True,
                                   base_url='http://localhost:13000')
@@ -350,8 +521,7 @@ class ApiClientTestCase(testtools.TestCase):
 
 
 class GetNodesMock():
-    def json(self):
-        return json.loads("""[
+    content = b"""[
 {
     "name": "sf-1.c.mikal-269605.internal",
     "ip": "10.128.15.213",
@@ -363,7 +533,7 @@ class GetNodesMock():
     "lastseen": "Mon, 13 Apr 2020 03:04:17 -0000"
 }
 ]
-""")
+"""
 
 
 class ApiClientGetNodesTestCase(testtools.TestCase):
@@ -372,7 +542,7 @@ class ApiClientGetNodesTestCase(testtools.TestCase):
 
         self.capabilities = mock.patch(
             'shakenfist_client.apiclient.Client._collect_capabilities')
-        self.capabilities = self.capabilities.start()
+        self.mock_capabilities = self.capabilities.start()
         self.addCleanup(self.capabilities.stop)
 
     @mock.patch('shakenfist_client.apiclient.Client._request_url',
@@ -384,3 +554,363 @@ class ApiClientGetNodesTestCase(testtools.TestCase):
 
         mock_request.assert_called_with(
             'GET', '/nodes')
+
+
+class PollDelayTestCase(testtools.TestCase):
+    def test_poll_delay_capped(self):
+        for attempt in range(20):
+            delay = apiclient._poll_delay(attempt, base=0.1, cap=5.0)
+            self.assertTrue(0 <= delay <= min(5.0, 0.1 * 2 ** attempt))
+
+    def test_poll_delay_many_attempts(self):
+        # Long blocking waits never reset attempt, this must not overflow
+        delay = apiclient._poll_delay(2000, base=0.1, cap=5.0)
+        self.assertTrue(0 <= delay <= 5.0)
+
+    @mock.patch('time.time', return_value=100.0)
+    def test_poll_delay_respects_deadline(self, mock_time):
+        self.assertEqual(0, apiclient._poll_delay(10, deadline=99.0))
+        self.assertTrue(apiclient._poll_delay(10, deadline=100.5) <= 0.5)
+
+    def test_parse_retry_after(self):
+        self.assertEqual(3.0, apiclient._parse_retry_after('3'))
+        self.assertIsNone(apiclient._parse_retry_after(None))
+        self.assertIsNone(apiclient._parse_retry_after(
+            'Wed, 21 Oct 2015 07:28:00 GMT'))
+
+
+class EndpointCacheTestCase(testtools.TestCase):
+    def setUp(self):
+        super().setUp()
+
+        tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tempdir)
+        self.endpoint_cache = mock.patch(
+            'shakenfist_client.apiclient.ENDPOINT_CACHE',
+            os.path.join(tempdir, 'endpoint.json'))
+        self.endpoint_cache.start()
+        self.addCleanup(self.endpoint_cache.stop)
+
+        self.token_cache_path = os.path.join(tempdir, 'token.json')
+        self.token_cache = mock.patch(
+            'shakenfist_client.apiclient.TOKEN_CACHE', self.token_cache_path)
+        self.token_cache.start()
+        self.addCleanup(self.token_cache.stop)
+
+        self.capabilities = mock.patch(
+            'shakenfist_client.apiclient.Client._collect_capabilities')
+        self.capabilities.start()
+        self.addCleanup(self.capabilities.stop)
+
+        self.actual_request = mock.patch(
+            'shakenfist_client.apiclient.Client._actual_request_url')
+        self.mock_actual_request = self.actual_request.start()
+        self.addCleanup(self.actual_request.stop)
+
+    def test_auth_redirect_is_followed_and_cached(self):
+        redirect = mock.MagicMock()
+        redirect.status_code = 301
+        redirect.headers = {'Location': 'http://elsewhere:13000/api/auth'}
+        token = mock.MagicMock()
+        token.status_code = 200
+        token.content = b'{"access_token": "token"}'
+
+        session = mock.MagicMock()
+        session.request.side_effect = [redirect, token]
+        client = apiclient.Client(suppress_configuration_lookup=True,
+                                  base_url='http://localhost:13000',
+                                  session=session, persistent_cache=True)
+        client._request_url('GET', '/instances')
+        self.assertEqual('http://elsewhere:13000/api', client.base_url)
+        self.assertEqual('Bearer token', client.cached_auth)
+        self.assertEqual(
+            ['http://localhost:13000/auth', 'http://elsewhere:13000/api/auth'],
+            [c[0][1] for c in session.request.call_args_list])
+        self.assertEqual(0o600, os.stat(apiclient.ENDPOINT_CACHE).st_mode & 0o777)
+
+        # A second client starts at the cached location
+        session = mock.MagicMock()
+        session.request.return_value = token
+        client = apiclient.Client(suppress_configuration_lookup=True,
+                                  base_url='http://localhost:13000',
+                                  session=session, persistent_cache=True)
+        client._request_url('GET', '/instances')
+        self.assertEqual('http://elsewhere:13000/api', client.base_url)
+        session.request.assert_called_once_with(
+            'POST', 'http://elsewhere:13000/api/auth', data=mock.ANY,
+            headers={'Content-Type': 'application/json',
+                     'User-Agent': apiclient.get_user_agent()},
+            allow_redirects=False)
+
+    def test_no_cache_files_by_default(self):
+        redirect = mock.MagicMock()
+        redirect.status_code = 301
+        redirect.headers = {'Location': 'http://elsewhere:13000/api/auth'}
+        token = self._token_response(time.time() + 900)
+
+        session = mock.MagicMock()
+        session.request.side_effect = [redirect, token]
+        client = apiclient.Client(suppress_configuration_lookup=True,
+                                  base_url='http://localhost:13000',
+                                  session=session)
+        client._request_url('GET', '/instances')
+        self.assertEqual('http://elsewhere:13000/api', client.base_url)
+        self.assertFalse(os.path.exists(self.token_cache_path))
+        self.assertFalse(os.path.exists(apiclient.ENDPOINT_CACHE))
+
+    def _cached_endpoint_client(self):
+        apiclient._update_endpoint_cache(
+            'http://localhost:13000', 'http://elsewhere:13000/api')
+        token = mock.MagicMock()
+        token.status_code = 200
+        token.content = b'{"access_token": "token"}'
+        session = mock.MagicMock()
+        session.request.return_value = token
+        return apiclient.Client(suppress_configuration_lookup=True,
+                                base_url='http://localhost:13000',
+                                session=session, persistent_cache=True)
+
+    def _connect_failure(self):
+        return requests.exceptions.ConnectionError(
+            urllib3.exceptions.MaxRetryError(
+                None, 'http://elsewhere:13000/api/instances',
+                urllib3.exceptions.NewConnectionError(None, 'refused')))
+
+    def test_forbidden_does_not_forget_cached_endpoint(self):
+        client = self._cached_endpoint_client()
+        self.mock_actual_request.side_effect = apiclient.UnauthorizedException(
+            'API request failed', 'DELETE', '/instances/uuid', 403, 'denied')
+        self.assertRaises(apiclient.UnauthorizedException,
+                          client._request_url, 'DELETE', '/instances/uuid')
+        self.assertEqual(1, self.mock_actual_request.call_count)
+        self.assertEqual('http://elsewhere:13000/api',
+                         apiclient._lookup_cached_endpoint('http://localhost:13000'))
+
+    def test_connect_failure_resends_idempotent_request(self):
+        client = self._cached_endpoint_client()
+        self.mock_actual_request.side_effect = [self._connect_failure(), 'ok']
+        self.assertEqual('ok', client._request_url('GET', '/instances'))
+        self.assertEqual('http://localhost:13000', client.base_url)
+        self.assertEqual(2, self.mock_actual_request.call_count)
+
+    def test_connect_failure_does_not_resend_post(self):
+        client = self._cached_endpoint_client()
+        self.mock_actual_request.side_effect = [self._connect_failure(), 'ok']
+        self.assertRaises(requests.exceptions.ConnectionError,
+                          client._request_url, 'POST', '/instances')
+        self.assertEqual(1, self.mock_actual_request.call_count)
+        self.assertIsNone(
+            apiclient._lookup_cached_endpoint('http://localhost:13000'))
+
+    def test_dropped_connection_is_not_resent(self):
+        client = self._cached_endpoint_client()
+        self.mock_actual_request.side_effect = [
+            requests.exceptions.ConnectionError('Connection aborted'), 'ok']
+        self.assertRaises(requests.exceptions.ConnectionError,
+                          client._request_url, 'GET', '/instances')
+        self.assertEqual(1, self.mock_actual_request.call_count)
+
+    def _token_response(self, exp):
+        payload = base64.urlsafe_b64encode(
+            json.dumps({'exp': exp}).encode('utf-8')).decode('utf-8').rstrip('=')
+        token = mock.MagicMock()
+        token.status_code = 200
+        token.content = json.dumps(
+            {'access_token': f'header.{payload}.signature'}).encode('utf-8')
+        return token
+
+    def test_token_is_cached_between_clients(self):
+        session = mock.MagicMock()
+        session.request.return_value = self._token_response(time.time() + 900)
+        client = apiclient.Client(suppress_configuration_lookup=True,
+                                  base_url='http://localhost:13000',
+                                  namespace='system', key='secret',
+                                  session=session, persistent_cache=True)
+        client._request_url('GET', '/instances')
+        self.assertEqual(1, session.request.call_count)
+        self.assertEqual(0o600, os.stat(self.token_cache_path).st_mode & 0o777)
+        with open(self.token_cache_path) as f:
+            self.assertNotIn('secret', f.read())
+
+        # The same credentials skip authentication entirely
+        session = mock.MagicMock()
+        second = apiclient.Client(suppress_configuration_lookup=True,
+                                  base_url='http://localhost:13000',
+                                  namespace='system', key='secret',
+                                  session=session, persistent_cache=True)
+        second._request_url('GET', '/instances')
+        self.assertEqual(client.cached_auth, second.cached_auth)
+        session.request.assert_not_called()
+
+        # But a different key does not
+        session.request.return_value = self._token_response(time.time() + 900)
+        third = apiclient.Client(suppress_configuration_lookup=True,
+                                 base_url='http://localhost:13000',
+                                 namespace='system', key='other',
+                                 session=session, persistent_cache=True)
+        third._request_url('GET', '/instances')
+        self.assertEqual(1, session.request.call_count)
+
+    def test_nearly_expired_token_is_not_used(self):
+        session = mock.MagicMock()
+        session.request.return_value = self._token_response(time.time() + 30)
+        for _ in range(2):
+            client = apiclient.Client(suppress_configuration_lookup=True,
+                                      base_url='http://localhost:13000',
+                                      namespace='system', key='secret',
+                                      session=session, persistent_cache=True)
+            client._request_url('GET', '/instances')
+        self.assertEqual(2, session.request.call_count)
+
+
+class ExecutorTestCase(testtools.TestCase):
+    @mock.patch('shakenfist_client.apiclient.Client._collect_capabilities')
+    def test_executor_lazy_and_shutdown(self, mock_capabilities):
+        client = apiclient.Client(suppress_configuration_lookup=True,
+                                  base_url='http://localhost:13000',
+                                  session=mock.MagicMock())
+        self.assertIsNone(client._executor)
+        self.assertEqual([2, 4, 6],
+                         list(client.executor.map(lambda x: x * 2, [1, 2, 3])))
+        client.close()
+        self.assertIsNone(client._executor)
+
+
+class SharedClientTestCase(testtools.TestCase):
+    def setUp(self):
+        super().setUp()
+
+        self.capabilities = mock.patch(
+            'shakenfist_client.apiclient.Client._collect_capabilities')
+        self.capabilities.start()
+        self.addCleanup(self.capabilities.stop)
+
+    def test_rejected_token_refreshed_once(self):
+        client = apiclient.Client(suppress_configuration_lookup=True,
+                                  base_url='http://localhost:13000',
+                                  session=mock.MagicMock())
+        client.cached_auth = 'Bearer old'
+        client._authenticate = mock.MagicMock(return_value='Bearer new')
+
+        # Two requests were rejected with the old token, the second finds it
+        # has already been replaced.
+        client._refresh_authentication('Bearer old')
+        client._refresh_authentication('Bearer old')
+        self.assertEqual('Bearer new', client.cached_auth)
+        client._authenticate.assert_called_once_with()
+
+    def test_dropped_session_replaced_once(self):
+        response = mock.MagicMock()
+        response.status_code = 200
+        dropped = mock.MagicMock()
+        client = apiclient.Client(suppress_configuration_lookup=True,
+                                  base_url='http://localhost:13000',
+                                  session=dropped)
+        client.cached_auth = 'Bearer token'
+        replacement = mock.MagicMock()
+        replacement.request.return_value = response
+
+        # Another thread replaces the session while our request fails
+        def fail(*args, **kwargs):
+            client.session = replacement
+            raise requests.exceptions.ConnectionError()
+        dropped.request.side_effect = fail
+
+        with mock.patch('shakenfist_client.apiclient._make_session') as make:
+            self.assertIs(response, client._actual_request_url('GET', '/nodes'))
+        make.assert_not_called()
+        self.assertIs(replacement, client.session)
+
+
+class ConfigFileTestCase(testtools.TestCase):
+    def test_load_config_file_cached_until_changed(self):
+        tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tempdir)
+        path = os.path.join(tempdir, 'shakenfist.json')
+
+        self.assertIsNone(apiclient._load_config_file(path))
+
+        with open(path, 'w') as f:
+            f.write('{"apiurl": "http://a", "namespace": "n", "key": "k"}')
+        first = apiclient._load_config_file(path)
+        self.assertEqual('http://a', first['apiurl'])
+        self.assertIs(first, apiclient._load_config_file(path))
+
+        with open(path, 'w') as f:
+            f.write('{"apiurl": "http://bb", "namespace": "n", "key": "k"}')
+        self.assertEqual('http://bb', apiclient._load_config_file(path)['apiurl'])
+
+    @mock.patch('shakenfist_client.apiclient._read_config_file',
+                side_effect=PermissionError())
+    def test_load_config_file_unreadable(self, mock_read):
+        tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tempdir)
+        path = os.path.join(tempdir, 'shakenfist.json')
+        with open(path, 'w') as f:
+            f.write('{}')
+
+        self.assertIsNone(apiclient._load_config_file(path))
+
+
+class TransientErrorTestCase(testtools.TestCase):
+    def setUp(self):
+        super().setUp()
+
+        self.capabilities = mock.patch(
+            'shakenfist_client.apiclient.Client._collect_capabilities')
+        self.capabilities.start()
+        self.addCleanup(self.capabilities.stop)
+
+        self.sleep = mock.patch('time.sleep')
+        self.mock_sleep = self.sleep.start()
+        self.addCleanup(self.sleep.stop)
+
+    def _client(self, *responses):
+        client = apiclient.Client(suppress_configuration_lookup=True,
+                                  base_url='http://localhost:13000')
+        client.cached_auth = 'Bearer token'
+        client._actual_request_url = mock.MagicMock(side_effect=responses)
+        return client
+
+    def test_rate_limited_retries_with_retry_after(self):
+        client = self._client(
+            apiclient.RateLimitedException('', 'GET', '/', 429, '',
+                                           retry_after=2.0),
+            'ok')
+        self.assertEqual('ok', client._request_url('GET', '/instances'))
+        self.mock_sleep.assert_called_once_with(2.0)
+
+    def test_gateway_timeout_not_retried_for_post(self):
+        client = self._client(
+            apiclient.GatewayTimeoutException('', 'POST', '/', 504, ''),
+            'ok')
+        self.assertRaises(apiclient.GatewayTimeoutException,
+                          client._request_url, 'POST', '/instances')
+        self.mock_sleep.assert_not_called()
+
+
+class CorrectBlobIndexesTestCase(testtools.TestCase):
+    def test_correct_blob_indexes(self):
+        self.assertEqual(
+            {'uuid': 'a', 'blobs': {1: {'uuid': 'b1'}, 2: {'uuid': 'b2'}}},
+            apiclient._correct_blob_indexes(
+                {'uuid': 'a', 'blobs': {'1': {'uuid': 'b1'}, '2': {'uuid': 'b2'}}}))
+
+    def test_correct_blob_indexes_no_blobs(self):
+        self.assertEqual({'uuid': 'a', 'blobs': {}},
+                         apiclient._correct_blob_indexes({'uuid': 'a'}))
+
+
+class CapabilitiesTestCase(testtools.TestCase):
+    def test_capabilities_fetched_lazily(self):
+        session = mock.MagicMock()
+        session.request.return_value.text = 'blob-data-limit'
+        client = apiclient.Client(suppress_configuration_lookup=True,
+                                  base_url='http://localhost:13000',
+                                  session=session)
+        session.request.assert_not_called()
+
+        self.assertTrue(client.check_capability('blob-data-limit'))
+        self.assertTrue(client.check_capability('blob-data-limit'))
+        session.request.assert_called_once_with(
+            'GET', 'http://localhost:13000', allow_redirects=True)